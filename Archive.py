@@ -1,28 +1,52 @@
+import time
+
+# Start of the start-up timings reported by --profile-startup, taken before anything else is imported
+STARTED = time.perf_counter()
+
 from textual.app import App, ComposeResult
 from textual.containers import Center, Horizontal, Container
-from textual.screen import ModalScreen
+from textual.screen import ModalScreen, Screen
+from textual.scroll_view import ScrollView
+from textual.widget import Widget
+from textual.lazy import Lazy
+from textual.strip import Strip
+from textual.geometry import Size
 from textual.reactive import reactive
-from textual.widgets import Header, Footer, Label, TabbedContent, TabPane, Markdown, Input, Button, DataTable
-from textual import on
+from textual.widgets import Header, Footer, Label, TabbedContent, TabPane, Markdown, Input, Button, DataTable, ProgressBar
+from textual import on, work
+from rich.text import Text
+from rich.segment import Segment
+from rich.cells import set_cell_size
+from collections import OrderedDict
+from textual.worker import Worker, get_current_worker
 import sqlite3
+import argparse
+
+from library import (Book, book_search_api, book_api_search_results, response_cache, read_isbn_file, import_isbns, add_to_collection,
+                     search_collection, fuzzy_search_collection, collection_reader, interrupt_collection_search,
+                     HIGHLIGHT_START, HIGHLIGHT_END, COLLECTION_PAGE_SIZE, collection_count, collection_page, collection_id_before,
+                     collection_summary, metadata_mirror, refresh_stale_volumes, rate_limiter)
+
+from database import database, DATABASE_ENV
+from isbn import is_valid_isbn
+from transfer import FORMATS, export_collection, import_collection
+from covers import cover_cache, COVER_WIDTH, COVER_HEIGHT
+from stats import stats, STATS_FILE, STATS_PERCENTILES
 
-from library import book_search_api, book_api_search_results
+# Times at which each stage of start-up was reached, in order, for --profile-startup
+startup_times = {"imports": time.perf_counter()}
 
-#Initial connection to database, creation upon initial running of program
-conn = sqlite3.connect("Archive.db")
-cursor = conn.cursor()
+def mark_startup(stage):
+    startup_times.setdefault(stage, time.perf_counter())
 
-#SQL table to sort through entries, using ids from each to reduce search sizes
-cursor.execute('''
-    CREATE TABLE IF NOT EXISTS book_list (
-        id PRIMARY KEY,
-        title TEXT NOT NULL,
-        author TEXT NOT NULL,
-        pub_year TEXT,
-        ISBN13 TEXT,
-        ISBN10 TEXT
-    );
-''')
+# Prints how long each stage of start-up took, and the time since the process started importing the app
+def startup_report():
+    lines = [f"{'Stage':<20}{'Took (ms)':>12}{'Total (ms)':>12}"]
+    previous = STARTED
+    for stage, reached in startup_times.items():
+        lines.append(f"{stage:<20}{(reached - previous) * 1000:>12.1f}{(reached - STARTED) * 1000:>12.1f}")
+        previous = reached
+    return "\n".join(lines)
 
 # Main tab text and organization set-up
 HOME = """
@@ -44,6 +68,173 @@ A collection of the books that you own, as well as the ability to add or remove
 
 BOOK_SEARCH = [("Title", "Author", "Published", "ISBN13", "ISBN10")]
 
+# Number of search results added to the table per update while a search streams in
+API_ROW_BATCH = 10
+
+# Rows read per page by the collection browser, how many pages it keeps in memory, and how many pages ahead of a
+# far away page it will walk instead of jumping straight there
+BROWSE_PAGE_SIZE = 100
+BROWSE_CACHED_PAGES = 8
+BROWSE_WALK_PAGES = 2
+
+# Seconds between checks for saved volumes that are due to be refreshed from the API
+MIRROR_REFRESH_INTERVAL = 10 * 60
+
+# Seconds to wait after the last keystroke before searching the collection, and how close (in rows) the cursor
+# has to get to the bottom of the results before the next page is loaded
+SEARCH_DEBOUNCE = 0.15
+PAGE_PREFETCH = 10
+
+# Seconds typing has to pause, after a search with no exact matches, before close matches are looked for. That
+# search costs far more than an exact one, so it isn't run for every keystroke
+CLOSE_MATCH_DELAY = 0.5
+
+# Seconds between updates of the Stats tab while it is open
+STATS_REFRESH_INTERVAL = 1.0
+
+STATS_OFF = ("Timing is off. Start Archive with --stats to time API requests, SQL statements, table updates and "
+             "screen refreshes.")
+
+# Turns text with search highlight markers into bold text for a table cell
+def highlighted(value):
+    if value is None:
+        return ""
+    text = Text()
+    first, *matches = value.split(HIGHLIGHT_START)
+    text.append(first)
+    for match in matches:
+        word, _, rest = match.partition(HIGHLIGHT_END)
+        text.append(word, style="bold")
+        text.append(rest)
+    return text
+
+# Scrollable view of the whole collection that only reads the rows it shows. Rows are read a page at a time in id
+# order, and only the most recently used pages are kept, so opening and scrolling it costs the same whether the
+# collection holds a hundred books or a million. The id each page starts after is remembered, so moving to a
+# neighbouring page is a single index lookup
+class CollectionView(ScrollView):
+
+    DEFAULT_CSS = """
+    CollectionView {
+        height: 1fr;
+    }
+
+    CollectionView > .collection-view--header {
+        text-style: bold;
+        background: $panel;
+    }
+
+    CollectionView > .collection-view--odd-row {
+        background: $surface-lighten-1;
+    }
+    """
+
+    COMPONENT_CLASSES = {"collection-view--header", "collection-view--odd-row"}
+
+    COLUMNS = [("Title", 40), ("Author", 24), ("Published", 10), ("ISBN13", 13), ("ISBN10", 10)]
+
+    def __init__(self, page_size: int = BROWSE_PAGE_SIZE, cached_pages: int = BROWSE_CACHED_PAGES, **kwargs) -> None:
+        super().__init__(**kwargs)
+        self.page_size = page_size
+        self.cached_pages = cached_pages
+        self.pages = OrderedDict()
+        self.page_starts = {0: 0}
+        self.row_count = 0
+
+    # Forgets the loaded pages and re-counts the collection, after books have been added or removed
+    def reload(self) -> None:
+        self.pages.clear()
+        self.page_starts = {0: 0}
+        with database.read() as conn:
+            self.row_count = collection_count(conn)
+        self.virtual_size = Size(sum(width + 1 for _, width in self.COLUMNS), self.row_count + 1)
+        self.refresh()
+
+    # Rows of one page, read from the database if it isn't one of the cached pages
+    def get_page(self, page: int) -> list:
+        if page in self.pages:
+            self.pages.move_to_end(page)
+            return self.pages[page]
+        if page not in self.page_starts:
+            # Walk forward from a nearby known page, otherwise look up where the page starts, counting from the
+            # closest known page (or the end of the collection)
+            known = max(known for known, start in self.page_starts.items() if known < page and start is not None)
+            if page - known <= BROWSE_WALK_PAGES:
+                for step in range(known, page):
+                    self.get_page(step)
+            else:
+                with database.read() as conn:
+                    self.page_starts[page] = collection_id_before(conn, page * self.page_size, self.page_starts[known],
+                                                                  known * self.page_size, self.row_count)
+        with database.read() as conn:
+            rows = collection_page(conn, self.page_starts[page] or 0, self.page_size)
+        if rows:
+            self.page_starts[page + 1] = rows[-1][0]
+        self.pages[page] = rows
+        if len(self.pages) > self.cached_pages:
+            self.pages.popitem(last=False)
+        return rows
+
+    # Reads the page after the visible rows once the screen has been drawn, so scrolling down doesn't wait on it
+    def watch_scroll_y(self, old_value: float, new_value: float) -> None:
+        super().watch_scroll_y(old_value, new_value)
+        self.call_after_refresh(self.prefetch)
+
+    def prefetch(self) -> None:
+        last_visible = int(self.scroll_y) + self.size.height
+        if last_visible < self.row_count:
+            self.get_page(last_visible // self.page_size)
+
+    def render_cells(self, values, style) -> Strip:
+        segments = [Segment(set_cell_size("" if value is None else str(value), width) + " ", style)
+                    for value, (_, width) in zip(values, self.COLUMNS)]
+        return Strip(segments, self.virtual_size.width)
+
+    # The first line is the column header, the rest show the rows under the scroll position
+    def render_line(self, y: int) -> Strip:
+        scroll_x, scroll_y = self.scroll_offset
+        width = self.size.width
+        if y == 0:
+            style = self.get_component_rich_style("collection-view--header")
+            return self.render_cells([name for name, _ in self.COLUMNS], style).crop_extend(scroll_x, scroll_x + width, style)
+        position = scroll_y + y - 1
+        if position >= self.row_count:
+            return Strip.blank(width, self.rich_style)
+        page, index = divmod(position, self.page_size)
+        rows = self.get_page(page)
+        if index >= len(rows):
+            return Strip.blank(width, self.rich_style)
+        style = self.get_component_rich_style("collection-view--odd-row") if position % 2 else self.rich_style
+        return self.render_cells(rows[index][1:], style).crop_extend(scroll_x, scroll_x + width, style)
+
+# Cover of a book, drawn in half blocks. Covers are fetched in the background, and the space stays blank until the
+# cover is ready (or if the book has none)
+class CoverArt(Widget):
+    DEFAULT_CSS = f"""
+    CoverArt {{
+        width: {COVER_WIDTH};
+        height: {COVER_HEIGHT};
+    }}
+    """
+
+    isbn13 = None
+    strips = None
+
+    def show(self, isbn13) -> None:
+        self.isbn13 = isbn13
+        self.strips = cover_cache.get(isbn13, on_ready=lambda isbn13, strips: self.app.call_from_thread(self.cover_ready, isbn13, strips))
+        self.refresh()
+
+    def cover_ready(self, isbn13, strips: list) -> None:
+        if isbn13 == self.isbn13:
+            self.strips = strips
+            self.refresh()
+
+    def render_line(self, y: int) -> Strip:
+        if self.strips is not None and y < len(self.strips):
+            return self.strips[y]
+        return Strip.blank(self.size.width)
+
 # Modal pop-up screen to add items to your collection 
 class Add_Screen(ModalScreen):
 
@@ -65,6 +256,10 @@ class Add_Screen(ModalScreen):
         margin-top: 1;
     }
 
+    Add_Screen > Container > Center {
+        margin-top: 1;
+    }
+
     Add_Screen > Container > Horizontal {
         width: auto;
         height: auto;
@@ -83,21 +278,111 @@ class Add_Screen(ModalScreen):
     def compose(self) -> ComposeResult:
         with Container():
             yield Label("Add book to your collection?")
-            yield Label(f"{self.book}", id = "book_info")
+            if cover_cache.enabled:
+                yield Center(CoverArt(id = "book_cover"))
+            yield Label(f"{self.book}", id = "book_info", markup = False)
             with Horizontal():
                 yield Button("Yes", id = "add_api_book")
                 yield Button("No", id = "cancel_api_book")
 
+    def on_mount(self) -> None:
+        if cover_cache.enabled:
+            self.query_one("#book_cover", CoverArt).show(self.book.isbn13)
+
     # Takes results and adds to your collection
     @on(Button.Pressed, "#add_api_book")
     def add_api_book(self) -> None:
-        self.query_one("#book_info", Label).update("Test Successful")
+        if add_to_collection(self.book):
+            self.query_one("#book_info", Label).update(f"Added {self.book.title} to your collection")
+        else:
+            self.query_one("#book_info", Label).update(f"{self.book.title} is already in your collection")
 
     # Closes the screen
     @on(Button.Pressed, "#cancel_api_book")
     def cancel_api_book(self) -> None:
         self.app.pop_screen()
 
+# Modal pop-up screen to bulk import books from a file of ISBNs, such as a barcode scanner dump
+class Import_Screen(ModalScreen):
+
+    CSS = """
+    Import_Screen {
+        align: center middle;
+    }
+
+    Import_Screen > Container {
+        width: 80;
+        height: auto;
+        border: thick $background 80%;
+        background: $surface;
+    }
+
+    Import_Screen > Container > Label, Import_Screen > Container > ProgressBar {
+        width: 100%;
+        content-align-horizontal: center;
+        margin-top: 1;
+    }
+
+    Import_Screen > Container > Horizontal {
+        width: auto;
+        height: auto;
+    }
+
+    Import_Screen > Container > Horizontal > Button {
+        margin: 1 4;
+    }
+    """
+
+    def compose(self) -> ComposeResult:
+        with Container():
+            yield Label("Import books from a file of ISBNs")
+            yield Input(placeholder="Path to ISBN file", type="text", id="import_path")
+            yield ProgressBar(id="import_progress")
+            yield Label("", id="import_status")
+            with Horizontal():
+                yield Button("Import", id="start_import")
+                yield Button("Close", id="close_import")
+
+    @on(Button.Pressed, "#start_import")
+    def start_import(self) -> None:
+        path = self.query_one("#import_path", Input).value.strip()
+        try:
+            isbns = read_isbn_file(path)
+        except OSError as e:
+            self.query_one("#import_status", Label).update(f"Could not read the file: {e}")
+            return
+        self.query_one("#import_progress", ProgressBar).update(total=len(isbns), progress=0)
+        self.query_one("#import_status", Label).update(f"Importing {len(isbns)} ISBNs...")
+        self.import_books(isbns)
+
+    # Runs the import in a thread worker, reporting progress back to the progress bar
+    @work(exclusive=True, thread=True, group="import")
+    def import_books(self, isbns: list) -> None:
+        worker = get_current_worker()
+        progress_bar = self.query_one("#import_progress", ProgressBar)
+        counts = import_isbns(isbns,
+                              progress=lambda done, total: self.app.call_from_thread(progress_bar.update, progress=done),
+                              cancelled=lambda: worker.is_cancelled)
+        if not worker.is_cancelled:
+            self.app.call_from_thread(self.query_one("#import_status", Label).update,
+                                      f"Added {counts['added']}, already in collection {counts['duplicate']}, "
+                                      f"not found {counts['not_found']}, invalid {counts['invalid']}, failed {counts['failed']}")
+
+    # Closes the screen, cancelling an import that is still running
+    @on(Button.Pressed, "#close_import")
+    def close_import(self) -> None:
+        self.workers.cancel_group(self, "import")
+        self.app.pop_screen()
+
+# Screen that times each of its refreshes (laying out and drawing the widgets that changed) for the Stats tab.
+# Textual has no public hook around a screen refresh, so this overrides the private Screen._on_timer_update, as
+# found in the bundled Textual 6.6.0. Check it still exists (and still does the refresh) when Textual is upgraded;
+# without it the app falls back to a plain Screen and screen refreshes simply aren't timed
+class TimedScreen(Screen):
+    def _on_timer_update(self) -> None:
+        with stats.timed("screen refresh"):
+            super()._on_timer_update()
+
 # Textual terminal app set-up and declaration. The structure is designed around a tabbed terminal, where each window of the terminal
 # is a different archive section that can be utilized. Each tab is hotkeyed, which is displayed in the footer.
 class Archive(App):
@@ -106,29 +391,91 @@ class Archive(App):
     BINDINGS = [
         ("h", "show_tab('home')", "Home"),
         ("l", "show_tab('library')", "Library"),
-        ("a", "add_book", "Add Book")
+        ("a", "add_book", "Add Book"),
+        ("i", "import_books", "Import ISBNs"),
+        ("s", "show_tab('stats')", "Stats")
     ]
 
     CSS = """
-    TabbedContent, DataTable {
+    TabbedContent, DataTable, #book_personal_results, #summary_tables {
         height: 1fr
     }
+
+    #book_personal_cover {
+        margin-left: 1;
+    }
+
+    .summary_table {
+        width: 1fr;
+        margin-right: 1;
+    }
+
+    #stats_buttons {
+        height: auto;
+    }
     """
     book_row_info = reactive("")
     active_current = reactive("", init = None)
 
+    # State of the live collection search: the pending debounce timer, the current search inputs, and whether
+    # there are more results than the pages loaded so far
+    personal_search_timer = None
+    personal_search = ("", "", "")
+    personal_search_more = False
+
+    # State of the API search: the current search inputs, and the index of the next page to fetch (None when
+    # there are no more pages, or one is already being fetched)
+    api_search = ("", "", "")
+    api_search_next = None
+
+    # Whether to exit once start-up has finished, for --profile-startup, and the file the Stats tab saves to
+    profile_startup = False
+    stats_file = STATS_FILE
+
+    # The database is opened (and migrated, if it needs to be) in a worker once the first frame has been drawn,
+    # so the window shows straight away however long that takes
+    def on_mount(self) -> None:
+        self.title = "Archive"
+        mark_startup("mounted")
+        self.call_after_refresh(self.first_frame)
+        if stats.enabled:
+            self.set_interval(STATS_REFRESH_INTERVAL, self.update_stats)
+
+    def get_default_screen(self) -> Screen:
+        if stats.enabled and hasattr(Screen, "_on_timer_update"):
+            return TimedScreen(id="_default")
+        return super().get_default_screen()
+
+    def first_frame(self) -> None:
+        mark_startup("first frame")
+        self.open_database()
+
+    @work(thread=True, group="open_database")
+    def open_database(self) -> None:
+        database.connect_writer()
+        self.call_from_thread(self.database_ready)
+
+    # Saved volumes are checked for refreshing once the database is open and then every MIRROR_REFRESH_INTERVAL seconds
+    def database_ready(self) -> None:
+        mark_startup("database opened")
+        self.refresh_mirror()
+        self.set_interval(MIRROR_REFRESH_INTERVAL, self.refresh_mirror)
+        if self.profile_startup:
+            self.exit()
+
     def compose(self) -> ComposeResult:
         # Composing the app with tabbed content
         # Footer to show keys
         yield Footer()
         yield Header()
         book_api_table = DataTable(id="book_api_search_table")
+        book_api_table.add_columns(*BOOK_SEARCH[0])
+        book_api_table.zebra_stripes = True
+        book_api_table.cursor_type = "row"
         book_table = DataTable(id="book_personal_search_table")
         book_table.add_columns(*BOOK_SEARCH[0])
         book_table.zebra_stripes = True
-
-        def on_mount(self) -> None:
-            self.title = "Archive"
+        book_table.cursor_type = "row"
 
         # Adding tabbed content
         with TabbedContent(initial = "home", id = "archive"): # Sets the home tab as the initial starting point
@@ -137,16 +484,16 @@ class Archive(App):
             with TabPane("Home", id="home"):
                 yield Markdown(HOME)
             
-            # The library tab, used to sort books
+            # The library tab, used to sort books. It starts hidden, so its contents are mounted after the first frame
             with TabPane("Library", id="library"):
-                yield Markdown(LIBRARY)
+                yield Lazy(Markdown(LIBRARY))
 
                 # Sub tabs to search online for a book to add, or to search through your own collection
-                with TabbedContent("Book Search", "Collection", id = "book_tabs"):
+                with Lazy(TabbedContent("Book Search", "Collection", "Browse", "Summary", id = "book_tabs")):
                     with TabPane("Book Search", Label("Find a Book Through an Online Search"), id = "apibook_tab"):
                         yield Input(placeholder="Title", type="text", id="book_title_api")
                         yield Input(placeholder="Author", type="text", id="book_author_api")
-                        yield Input(placeholder="ISBN", type="text", id="book_isbn_api")
+                        yield Input(placeholder="ISBN", type="text", restrict=r"[0-9Xx\- ]*", id="book_isbn_api")
                         yield Center(Button("Search", id="book_search_api"))
                         yield Center(Label("", id="book_api_status"))
                         yield Center(Label("", id="book_api_search_error"))
@@ -155,12 +502,64 @@ class Archive(App):
                     with TabPane("Collection", Label("Search Through Your Personal Collection"), id = "personalbook_tab"):
                         yield Input(placeholder="Title", type="text", id="book_title_personal")
                         yield Input(placeholder="Author", type="text", id="book_author_personal")
-                        yield Input(placeholder="ISBN", type="integer", id="book_isbn_personal")
+                        yield Input(placeholder="ISBN", type="text", restrict=r"[0-9Xx\- ]*", id="book_isbn_personal")
                         with Center():
                             yield Button("Search", id="book_search_personal")
                         with Center():
                             yield Label("", id="book_personal_status")
+                        with Horizontal(id="book_personal_results"):
+                            yield book_table
+                            if cover_cache.enabled:
+                                yield CoverArt(id="book_personal_cover")
+
+                    with TabPane("Browse", Label("Browse Your Whole Collection"), id = "browsebook_tab"):
+                        yield CollectionView(id="book_browse")
+
+                    with TabPane("Summary", Label("Summary of Your Collection"), id = "summarybook_tab"):
+                        yield Label("", id="summary_totals")
+                        with Horizontal(id="summary_tables"):
+                            for table_id, heading in (("summary_authors", "Author"), ("summary_decades", "Decade"),
+                                                      ("summary_media", "Media type")):
+                                summary_table = DataTable(id=table_id, classes="summary_table")
+                                summary_table.add_columns(heading, "Count")
+                                summary_table.zebra_stripes = True
+                                yield summary_table
+
+            # The stats tab, showing how long API requests, SQL statements, table updates and refreshes take
+            with TabPane("Stats", id="stats"):
+                yield Label(STATS_OFF if not stats.enabled else "", id="stats_status")
+                stats_table = DataTable(id="stats_table")
+                stats_table.add_columns("Timed", "Count", "Mean (ms)", *(f"p{percent} (ms)" for percent in STATS_PERCENTILES), "Max (ms)")
+                stats_table.zebra_stripes = True
+                yield stats_table
+                if stats.enabled:
+                    with Horizontal(id="stats_buttons"):
+                        yield Button("Save", id="save_stats")
+                        yield Button("Reset", id="reset_stats")
     
+    # Shows the latest timings while the Stats tab is open
+    @on(TabbedContent.TabActivated, "#archive", pane="#stats")
+    def update_stats(self) -> None:
+        if not stats.enabled or self.query_one("#archive", TabbedContent).active != "stats":
+            return
+        stats_table = self.query_one("#stats_table", DataTable)
+        stats_table.clear()
+        for name, summary in stats.snapshot().items():
+            stats_table.add_row(name, summary["count"], *(f"{value * 1000:.2f}" for key, value in summary.items() if key != "count"))
+
+    @on(Button.Pressed, "#save_stats")
+    def save_stats(self) -> None:
+        try:
+            self.query_one("#stats_status", Label).update(f"Timings saved to {stats.dump(self.stats_file)}")
+        except OSError as e:
+            self.query_one("#stats_status", Label).update(f"The timings could not be saved: {e}")
+
+    @on(Button.Pressed, "#reset_stats")
+    def reset_stats(self) -> None:
+        stats.clear()
+        self.query_one("#stats_status", Label).update("Timings reset")
+        self.update_stats()
+
     # Initial search through API for books, while checking if inputs are present
     def on_button_pressed(self, event: Button.Pressed) -> None:
         if event.button.id == "book_search_api":
@@ -171,33 +570,212 @@ class Archive(App):
 
             if input_title_api.value == "" and input_author_api.value == "" and input_isbn_api.value == "":
                 self.query_one("#book_api_status", Label).update("Please input a minimum of a title, an author, or an ISBN number to search")
+            elif input_isbn_api.value != "" and not is_valid_isbn(input_isbn_api.value):
+                self.query_one("#book_api_status", Label).update("Please enter a valid ISBN-10 or ISBN-13")
             else:
-                self.update_book_search_api()
-                self.query_one("#book_api_status", Label).update("Search results")
+                self.api_search = (input_title_api.value, input_author_api.value, input_isbn_api.value)
+                self.api_search_next = None
+                self.query_one("#book_api_search_table", DataTable).clear()
+                self.query_one("#book_api_status", Label).update("Searching...")
+                self.update_book_search_api(*self.api_search, start_index=0)
     
-    # Return results of search for books with API based on inputs
-    def update_book_search_api(self) -> None:
-        book_table = self.query_one("#book_api_search_table", DataTable)
-        book_table.clear(columns=True)
-        input_title_api = self.query_one("#book_title_api", Input)
-        input_author_api = self.query_one("#book_author_api", Input)
-        input_isbn_api = self.query_one("#book_isbn_api", Input)
-        search_input = book_search_api(input_title_api.value, input_author_api.value, input_isbn_api.value)
-        search_results = book_api_search_results(search_input)
-        if type(search_results) == TypeError:
-            self.query_one("#book_api_status", Label).update(f"An unexpected error occured: {search_results}") 
-            self.query_one("#book_api_search_error2", Label).update("There may be a missing value in the API search. Please be more specific.")
+    # Search the collection as you type. Each keystroke restarts a short timer, so the search only runs once typing pauses
+    @on(Input.Changed, "#book_title_personal, #book_author_personal, #book_isbn_personal")
+    def queue_book_search_personal(self) -> None:
+        if self.personal_search_timer is not None:
+            self.personal_search_timer.stop()
+        self.personal_search_timer = self.set_timer(SEARCH_DEBOUNCE, lambda: self.update_book_search_personal(close_matches=False))
+
+    # The search button looks for close matches straight away, without waiting for typing to pause
+    @on(Button.Pressed, "#book_search_personal")
+    def search_book_personal_pressed(self) -> None:
+        self.update_book_search_personal(close_matches=True)
+
+    # Search through your own collection using the full-text index. The previous search is cancelled and its
+    # query interrupted, then the first page of results is loaded in a worker
+    def update_book_search_personal(self, close_matches: bool) -> None:
+        if self.personal_search_timer is not None:
+            self.personal_search_timer.stop()
+            self.personal_search_timer = None
+        self.personal_search = (self.query_one("#book_title_personal", Input).value,
+                                self.query_one("#book_author_personal", Input).value,
+                                self.query_one("#book_isbn_personal", Input).value)
+        self.personal_search_more = False
+        self.workers.cancel_group(self, "book_search_personal")
+        interrupt_collection_search()
+        if self.personal_search == ("", "", ""):
+            self.query_one("#book_personal_search_table", DataTable).clear()
+            self.query_one("#book_personal_status", Label).update("Please input a minimum of a title, an author, or an ISBN number to search")
         else:
-            book_table.add_columns(*BOOK_SEARCH[0])
-            book_table.add_rows(search_results[0:])
-            book_table.zebra_stripes = True
-            book_table.cursor_type = "row"
+            self.search_book_personal(*self.personal_search, offset=0, close_matches=close_matches)
+
+    # Loads one page of collection results off the UI thread. One extra row is fetched to tell whether there is another page
+    @work(exclusive=True, thread=True, group="book_search_personal")
+    def search_book_personal(self, title: str, author: str, isbn: str, offset: int, close_matches: bool = True) -> None:
+        worker = get_current_worker()
+        close = False
+        close_pending = False
+        try:
+            with stats.timed("collection search"), collection_reader() as conn:
+                results = search_collection(conn, title, author, isbn, limit=COLLECTION_PAGE_SIZE + 1, offset=offset)
+                # Nothing matches exactly, so look for books with a title or author close to it, in case of a typo
+                if not results and offset == 0 and not isbn and not worker.is_cancelled:
+                    if close_matches:
+                        results = fuzzy_search_collection(conn, title, author)
+                        close = True
+                    else:
+                        close_pending = True
+        except sqlite3.OperationalError:
+            # Interrupted by a newer search
+            return
+        if not worker.is_cancelled:
+            self.call_from_thread(self.show_book_search_personal, worker, results, offset, close, close_pending)
+
+    def show_book_search_personal(self, worker: Worker, results: list, offset: int, close: bool = False,
+                                  close_pending: bool = False) -> None:
+        if worker.is_cancelled:
+            return
+        # The next keystroke stops this timer, so close matches are only looked for once typing pauses
+        if close_pending:
+            self.personal_search_timer = self.set_timer(CLOSE_MATCH_DELAY,
+                                                        lambda: self.search_book_personal(*self.personal_search, offset=0))
+        book_table = self.query_one("#book_personal_search_table", DataTable)
+        with stats.timed("table update"):
+            if offset == 0:
+                book_table.clear()
+            book_table.add_rows((highlighted(row[1]), highlighted(row[2]), *row[3:]) for row in results[:COLLECTION_PAGE_SIZE])
+        self.personal_search_more = len(results) > COLLECTION_PAGE_SIZE
+        more = ", scroll down for more" if self.personal_search_more else ""
+        if close_pending:
+            self.query_one("#book_personal_status", Label).update("No exact matches, looking for close matches")
+        elif close and results:
+            self.query_one("#book_personal_status", Label).update(f"No exact matches, showing close matches ({book_table.row_count})")
+        else:
+            self.query_one("#book_personal_status", Label).update(f"Collection results ({book_table.row_count}{more})")
+
+    # Shows the cover of the highlighted book next to the collection results
+    @on(DataTable.RowHighlighted, "#book_personal_search_table")
+    def show_personal_cover(self, event: DataTable.RowHighlighted) -> None:
+        if cover_cache.enabled:
+            self.query_one("#book_personal_cover", CoverArt).show(event.data_table.get_row(event.row_key)[3])
+
+    # Load the next page of collection results as the cursor nears the bottom of the table
+    @on(DataTable.RowHighlighted, "#book_personal_search_table")
+    def load_book_search_personal_page(self, event: DataTable.RowHighlighted) -> None:
+        if self.personal_search_more and event.cursor_row >= event.data_table.row_count - PAGE_PREFETCH:
+            self.personal_search_more = False
+            self.search_book_personal(*self.personal_search, offset=event.data_table.row_count)
+
+    # Return one page of results of search for books with API based on inputs. Runs in a thread worker so a slow
+    # API call never blocks the event loop; exclusive cancels any older search still in flight when a new one starts
+    @work(exclusive=True, thread=True, group="book_search_api")
+    def update_book_search_api(self, title: str, author: str, isbn: str, start_index: int) -> None:
+        worker = get_current_worker()
+        # The first page starts with any matches saved in the local mirror, which show straight away and stay
+        # when the API can't be reached. API results that are already on screen are skipped
+        shown = set()
+        if start_index == 0:
+            saved = metadata_mirror.search(title, author, isbn)
+            if saved and not worker.is_cancelled:
+                shown.update(saved)
+                self.call_from_thread(self.add_book_api_rows, worker, saved)
+        # Rows are sent to the table in small batches as the response is read, so the first results show while
+        # the rest of the response is still arriving
+        rows = []
+        try:
+            search_input = book_search_api(title, author, isbn, start_index=start_index)
+            for row in book_api_search_results(search_input):
+                if worker.is_cancelled:
+                    search_input.close()
+                    return
+                if row in shown:
+                    continue
+                shown.add(row)
+                rows.append(row)
+                if len(rows) == API_ROW_BATCH:
+                    self.call_from_thread(self.add_book_api_rows, worker, rows)
+                    rows = []
+        except Exception as e:
+            if worker.is_cancelled:
+                return
+            if rows:
+                self.call_from_thread(self.add_book_api_rows, worker, rows)
+            if shown:
+                self.call_from_thread(self.finish_book_api_search, worker, None, "saved results, the API could not be reached")
+            else:
+                self.call_from_thread(self.show_book_api_error, worker, e)
+            return
+        if worker.is_cancelled:
+            return
+        if rows:
+            self.call_from_thread(self.add_book_api_rows, worker, rows)
+        # The whole response has been read, so the mirror has the thumbnail addresses of these books
+        cover_cache.prefetch(book.isbn13 for book in shown)
+        # The next page starts after every volume the API returned
+        returned = search_input.count
+        more = returned > 0 and start_index + returned < search_input.total_items
+        self.call_from_thread(self.finish_book_api_search, worker, start_index + returned if more else None)
+
+    # Refreshes saved volumes that are due for it from the API. Failures (such as being offline) are left for the next try
+    @work(exclusive=True, thread=True, group="refresh_mirror", exit_on_error=False)
+    def refresh_mirror(self) -> None:
+        refresh_stale_volumes()
+
+    # Adds a batch of search results, ignoring batches from a search that has since been replaced
+    def add_book_api_rows(self, worker: Worker, rows: list) -> None:
+        if worker.is_cancelled:
+            return
+        with stats.timed("table update"):
+            self.query_one("#book_api_search_table", DataTable).add_rows(rows)
+
+    def finish_book_api_search(self, worker: Worker, next_index, note: str = "") -> None:
+        if worker.is_cancelled:
+            return
+        self.api_search_next = next_index
+        count = self.query_one("#book_api_search_table", DataTable).row_count
+        more = ", scroll down for more" if next_index is not None else ""
+        note = f" - {note}" if note else ""
+        self.query_one("#book_api_status", Label).update(f"Search results ({count}{more}) - {response_cache.stats()}, "
+                                                         f"{rate_limiter.stats()}{note}")
+
+    # Fetch the next page of API results as the cursor nears the bottom of the table
+    @on(DataTable.RowHighlighted, "#book_api_search_table")
+    def load_book_search_api_page(self, event: DataTable.RowHighlighted) -> None:
+        if self.api_search_next is not None and event.cursor_row >= event.data_table.row_count - PAGE_PREFETCH:
+            start_index = self.api_search_next
+            self.api_search_next = None
+            self.update_book_search_api(*self.api_search, start_index=start_index)
+
+    def show_book_api_error(self, worker: Worker, error: Exception) -> None:
+        if worker.is_cancelled:
+            return
+        self.query_one("#book_api_status", Label).update(f"An unexpected error occured: {error}")
+        self.query_one("#book_api_search_error", Label).update("There may be a missing value in the API search. Please be more specific.")
 
     # Get results from search to add to collection
+    @on(DataTable.RowSelected, "#book_api_search_table")
     def on_data_table_row_selected(self, event: DataTable.RowSelected) -> None:
-        table = self.query_one("#book_api_search_table", DataTable)
-        self.book_row_info = table.get_row(event.row_key)
+        self.book_row_info = Book(*event.data_table.get_row(event.row_key))
     
+    # Show the latest books each time the collection browser is opened
+    @on(TabbedContent.TabActivated, "#book_tabs", pane="#browsebook_tab")
+    def reload_book_browse(self) -> None:
+        self.query_one("#book_browse", CollectionView).reload()
+
+    # Show the collection summary each time its tab is opened
+    @on(TabbedContent.TabActivated, "#book_tabs", pane="#summarybook_tab")
+    def show_collection_summary(self) -> None:
+        with database.read() as conn:
+            summary = collection_summary(conn)
+        self.query_one("#summary_totals", Label).update(
+            f"{summary.books} books, {summary.no_isbn} without an ISBN, {summary.duplicates} duplicate copies of "
+            f"{summary.duplicated_works} titles")
+        for table_id, rows in (("summary_authors", summary.authors), ("summary_decades", summary.decades),
+                               ("summary_media", summary.media_types)):
+            summary_table = self.query_one(f"#{table_id}", DataTable)
+            summary_table.clear()
+            summary_table.add_rows((value or "Unknown", count) for value, count in rows)
+
     # Navigation through the tabs
     def action_show_tab(self, tab: str) -> None:
         self.get_child_by_type(TabbedContent).active = tab
@@ -208,7 +786,44 @@ class Archive(App):
             self.push_screen(Add_Screen(self.book_row_info))
         else:
             return
+
+    # Start pop-up to bulk import books from a file of ISBNs
+    def action_import_books(self) -> None:
+        self.push_screen(Import_Screen())
         
 if __name__ == "__main__":
-    app = Archive()
-    app.run()
\ No newline at end of file
+    parser = argparse.ArgumentParser(description="A tool for organizing and searching for books and media in your collection.")
+    parser.add_argument("--database", metavar="FILE", help=f"database to use instead of the one in the user data directory "
+                                                           f"(also set by {DATABASE_ENV})")
+    parser.add_argument("--export", metavar="FILE", help="export the collection to FILE and exit")
+    parser.add_argument("--import", dest="import_file", metavar="FILE", help="add the books exported in FILE to the collection and exit")
+    parser.add_argument("--format", choices=FORMATS, help="file format, by default taken from the file extension")
+    parser.add_argument("--stats", action="store_true", help="time API requests, SQL statements, table updates and screen refreshes, "
+                                                             "shown on the Stats tab")
+    parser.add_argument("--stats-file", metavar="FILE", help=f"file the timings are saved to, also when the app exits "
+                                                             f"(implies --stats, default {STATS_FILE})")
+    parser.add_argument("--profile-startup", action="store_true", help="start the app, exit once it is ready and print how long each stage of start-up took")
+    args = parser.parse_args()
+    if args.database:
+        database.path = args.database
+    stats.enabled = args.stats or args.stats_file is not None
+
+    try:
+        if args.export:
+            print(f"Exported {export_collection(args.export, args.format)} books to {args.export}")
+        elif args.import_file:
+            read_count, added = import_collection(args.import_file, args.format)
+            print(f"Read {read_count} books from {args.import_file}, added {added} new to the collection")
+        else:
+            app = Archive()
+            app.profile_startup = args.profile_startup
+            app.stats_file = args.stats_file or STATS_FILE
+            mark_startup("app created")
+            app.run()
+            if args.profile_startup:
+                print(startup_report())
+            if args.stats_file:
+                print(f"Timings saved to {stats.dump(args.stats_file)}")
+    finally:
+        response_cache.close()
+        database.close()
@@ -0,0 +1,381 @@
+import argparse
+import asyncio
+import json
+import os
+import platform
+import random
+import shutil
+import statistics
+import subprocess
+import sys
+import tempfile
+import threading
+import time
+import urllib.parse
+import zlib
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+# resource is only available on Unix-like systems. Without it peak memory isn't measured
+try:
+    import resource
+except ImportError:
+    resource = None
+
+from isbn import to_isbn13
+
+
+# This script benchmarks Archive headlessly. For each collection size a synthetic database is built (and kept in the
+# work directory for later runs at the same schema version), then the app is driven through App.run_test in its own
+# process, on a copy of that database, against a local stand-in for the Books API. The timings are written as JSON, so runs from two commits can be compared with --compare
+#
+#   python benchmark.py --sizes 1000 100000 --output before.json
+#   python benchmark.py --sizes 1000 100000 --output after.json --compare before.json
+
+BENCHMARK_SIZES = (1000, 100000, 1000000)
+BENCHMARK_REPEATS = 5
+BENCHMARK_SEED = 1
+BENCHMARK_SCREEN = (160, 50)
+
+# Books inserted to measure insert throughput (removed again afterwards), rows added to measure how long the
+# DataTable takes to fill, and the number of results the local Books API has for every search
+INSERT_SAMPLE = 5000
+TABLE_FILL_ROWS = 1000
+STUB_TOTAL_ITEMS = 200
+
+# A change is reported by --compare when its median is this much slower or faster than before
+COMPARE_THRESHOLD = 0.10
+
+SYLLABLES = ("ka", "lo", "mir", "then", "dra", "vel", "shi", "on", "tor", "wyn", "bel", "ra", "quo", "sen", "fal",
+             "dor", "ith", "mae", "gor", "lin", "as", "pe", "ru", "zan", "cor", "el", "ny", "thar", "ob", "ix")
+
+# Deterministic word lists, so every run (and every commit) searches the same collection
+def synthetic_words(rng, count, syllables):
+    words = set()
+    while len(words) < count:
+        words.add("".join(rng.choice(SYLLABLES) for _ in range(rng.randint(*syllables))))
+    return sorted(words)
+
+class SyntheticBooks:
+    def __init__(self, seed=BENCHMARK_SEED):
+        rng = random.Random(seed)
+        self.title_words = [word.capitalize() for word in synthetic_words(rng, 5000, (1, 4))]
+        self.first_names = [word.capitalize() for word in synthetic_words(rng, 800, (2, 3))]
+        self.last_names = [word.capitalize() for word in synthetic_words(rng, 3000, (2, 4))]
+
+    # ISBNs are numbered from "start", so every book has a different, valid ISBN-13
+    def books(self, count, start=0, seed=BENCHMARK_SEED):
+        rng = random.Random(seed * 1000003 + start)
+        for number in range(start, start + count):
+            title = " ".join(rng.choice(self.title_words) for _ in range(rng.randint(1, 5)))
+            author = f"{rng.choice(self.first_names)} {rng.choice(self.last_names)}"
+            yield (title, author, str(rng.randint(1800, 2025)), isbn13(number), None)
+
+def isbn13(number):
+    digits = f"978{number % 10 ** 9:09d}"
+    check = (10 - sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(digits)) % 10) % 10
+    return to_isbn13(digits + str(check))
+
+# Builds the database for a collection size, unless an earlier run already built it with the same migrations (so a
+# commit that changes the schema gets a database built with its own migrations and triggers). Migrations that
+# haven't shipped can still be edited, so databases are named by a checksum of the migrations and not only by
+# their number. Returns its path and how many books per second were added while building it (None when it
+# already existed)
+def build_database(workdir, size, synthetic):
+    from database import Database, MIGRATIONS
+    from library import Book, CollectionRepository
+
+    schema = zlib.crc32("".join(MIGRATIONS).encode())
+    path = os.path.join(workdir, f"benchmark-{size}-v{len(MIGRATIONS)}-{schema:08x}.db")
+    if os.path.exists(path):
+        return path, None
+    building = path + ".building"
+    for suffix in ("", "-wal", "-shm"):
+        if os.path.exists(building + suffix):
+            os.remove(building + suffix)
+    db = Database(building)
+    start = time.perf_counter()
+    with CollectionRepository(db, batch_size=10000) as repository:
+        repository.add_many(Book(*book) for book in synthetic.books(size))
+    elapsed = time.perf_counter() - start
+    db.close()
+    os.replace(building, path)
+    return path, size / elapsed
+
+# A stand-in for the Books API, answering every search with STUB_TOTAL_ITEMS synthetic volumes
+class StubBooksHandler(BaseHTTPRequestHandler):
+    def log_message(self, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlparse(self.path)
+        query = urllib.parse.parse_qs(url.query)
+        if "/volumes/" in url.path:
+            items = [stub_volume(int(url.path.rsplit("vol", 1)[-1]))]
+            body = items[0]
+        else:
+            start = int(query.get("startIndex", ["0"])[0])
+            count = int(query.get("maxResults", ["10"])[0])
+            items = [stub_volume(number) for number in range(start, min(start + count, STUB_TOTAL_ITEMS))]
+            body = {"kind": "books#volumes", "totalItems": STUB_TOTAL_ITEMS, "items": items}
+        data = json.dumps(body).encode()
+        self.send_response(200)
+        self.send_header("Content-Type", "application/json")
+        self.send_header("Content-Length", str(len(data)))
+        self.end_headers()
+        self.wfile.write(data)
+
+def stub_volume(number):
+    return {"id": f"vol{number}", "volumeInfo": {
+        "title": f"Stub Volume {number}", "authors": [f"Stub Author {number % 13}"], "publishedDate": str(1900 + number % 120),
+        "industryIdentifiers": [{"type": "ISBN_13", "identifier": isbn13(900000000 + number)}]}}
+
+def serve_stub_api():
+    server = ThreadingHTTPServer(("127.0.0.1", 0), StubBooksHandler)
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    return server, f"http://127.0.0.1:{server.server_port}/books/v1/volumes"
+
+# Peak resident memory of this process in bytes (ru_maxrss is in kilobytes on Linux but bytes on macOS)
+def peak_rss():
+    if resource is None:
+        return None
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    return peak if sys.platform == "darwin" else peak * 1024
+
+def summarize(samples):
+    samples = sorted(samples)
+    return {
+        "median": statistics.median(samples),
+        "p95": samples[min(len(samples) - 1, round(0.95 * (len(samples) - 1)))],
+        "min": samples[0],
+        "max": samples[-1],
+        "samples": len(samples),
+    }
+
+# Searches run against the collection, built from the book in the middle of it: a one letter prefix, common words,
+# an author, a misspelt author (which falls through to the typo-tolerant search) and an exact ISBN
+def collection_queries(conn, size):
+    title, author, isbn = conn.execute("SELECT title, author, ISBN13 FROM book_list ORDER BY id LIMIT 1 OFFSET ?",
+                                       (size // 2,)).fetchone()
+    first_word = title.split()[0]
+    last_name = author.split()[-1]
+    typo = last_name[:2] + last_name[3] + last_name[2] + last_name[4:] if len(last_name) > 4 else last_name + "x"
+    return {
+        "prefix": (first_word[0], "", ""),
+        "title": (first_word, "", ""),
+        "title_author": (first_word, last_name, ""),
+        "author": ("", author, ""),
+        "fuzzy_author": ("", typo, ""),
+        "isbn": ("", "", isbn),
+    }
+
+# Runs the benchmarks against one database, in this process. ARCHIVE_DB has to point at the database before the
+# app is imported
+async def run_benchmarks(size, repeats):
+    import library
+    from Archive import Archive, CollectionView
+    from database import database
+    from library import Book, CollectionRepository
+    from textual.widgets import DataTable
+    from textual.worker import Worker
+
+    synthetic = SyntheticBooks()
+    server, url = serve_stub_api()
+    library.books_client = library.BooksClient(url=url, retries=0)
+    results = {}
+
+    def record(name, samples):
+        results[name] = summarize(samples)
+
+    # Insert throughput, measured on top of the existing collection and undone afterwards
+    insert_rates = []
+    for repeat in range(repeats):
+        start_number = size + repeat * INSERT_SAMPLE
+        start = time.perf_counter()
+        with CollectionRepository(database) as repository:
+            repository.add_many(Book(*book) for book in synthetic.books(INSERT_SAMPLE, start=start_number))
+        insert_rates.append(INSERT_SAMPLE / (time.perf_counter() - start))
+        with database.write() as conn:
+            conn.execute("DELETE FROM book_list WHERE id > (SELECT max(id) FROM book_list) - ?", (INSERT_SAMPLE,))
+    results["insert_rows_per_second"] = summarize(insert_rates)
+
+    start = time.perf_counter()
+    app = Archive()
+    async with app.run_test(size=BENCHMARK_SCREEN) as pilot:
+        await pilot.pause()
+        results["startup"] = {"seconds": time.perf_counter() - start}
+
+        # Time from starting an action to the screen having been updated. Actions started in a worker are waited for
+        async def timed(action):
+            start = time.perf_counter()
+            worker = action()
+            if isinstance(worker, Worker):
+                await worker.wait()
+            await pilot.pause()
+            return time.perf_counter() - start
+
+        # Switching between the main tabs and between the library's tabs, each until the new tab has been drawn
+        samples = []
+        for _ in range(repeats):
+            for tab in ("library", "home"):
+                samples.append(await timed(lambda: app.action_show_tab(tab)))
+        record("tab_switch", samples)
+        app.action_show_tab("library")
+        book_tabs = app.query_one("#book_tabs")
+        samples = {"apibook_tab": [], "personalbook_tab": [], "browsebook_tab": []}
+        for _ in range(repeats):
+            for pane in samples:
+                samples[pane].append(await timed(lambda: setattr(book_tabs, "active", pane)))
+        for pane, pane_samples in samples.items():
+            record(f"tab_switch_{pane}", pane_samples)
+
+        # Collection searches, from starting the search to the results being drawn
+        book_tabs.active = "personalbook_tab"
+        await pilot.pause()
+        with database.read() as conn:
+            queries = collection_queries(conn, size)
+        for name, query in queries.items():
+            record(f"collection_search_{name}", [await timed(lambda: app.search_book_personal(*query, offset=0))
+                                                 for _ in range(repeats)])
+
+        # API searches against the local stand-in, from the request to the first page being drawn. The cache is
+        # cleared before each cold search
+        book_tabs.active = "apibook_tab"
+        await pilot.pause()
+        api_table = app.query_one("#book_api_search_table", DataTable)
+        cold, warm = [], []
+        for _ in range(repeats):
+            library.response_cache.clear()
+            api_table.clear()
+            cold.append(await timed(lambda: app.update_book_search_api("stub", "", "", 0)))
+            api_table.clear()
+            warm.append(await timed(lambda: app.update_book_search_api("stub", "", "", 0)))
+        record("api_search_cold", cold)
+        record("api_search_cached", warm)
+
+        # Filling the collection results table with TABLE_FILL_ROWS rows
+        book_tabs.active = "personalbook_tab"
+        await pilot.pause()
+        personal_table = app.query_one("#book_personal_search_table", DataTable)
+        rows = list(synthetic.books(TABLE_FILL_ROWS, start=size))
+        samples = []
+        for _ in range(repeats):
+            personal_table.clear()
+            await pilot.pause()
+            samples.append(await timed(lambda: personal_table.add_rows(rows)))
+        record("table_fill", samples)
+
+        # Browsing: re-counting the collection, and jumping to the end of it
+        book_tabs.active = "browsebook_tab"
+        await pilot.pause()
+        view = app.query_one("#book_browse", CollectionView)
+        record("browse_reload", [await timed(view.reload) for _ in range(repeats)])
+        samples = []
+        for _ in range(repeats):
+            view.scroll_home(animate=False)
+            await pilot.pause()
+            samples.append(await timed(lambda: view.scroll_end(animate=False)))
+        record("browse_jump_to_end", samples)
+
+    server.shutdown()
+    database.close()
+    results["peak_rss_bytes"] = {"bytes": peak_rss()}
+    return results
+
+# Runs the benchmarks for one size in a new process, so each size starts from a cold app and has its own peak memory.
+# The app runs on a copy of the database, so the books, cached responses and covers it saves never reach the next run
+def run_size(path, size, repeats):
+    with tempfile.NamedTemporaryFile("r", suffix=".json", delete=False) as result_file:
+        result_path = result_file.name
+    run_path = os.path.join(os.path.dirname(path), f"run-{size}.db")
+    try:
+        shutil.copyfile(path, run_path)
+        environment = dict(os.environ, ARCHIVE_DB=run_path)
+        subprocess.run([sys.executable, os.path.abspath(__file__), "--run", str(size), "--repeats", str(repeats),
+                        "--result", result_path], env=environment, check=True)
+        with open(result_path) as result_file:
+            return json.load(result_file)
+    finally:
+        os.remove(result_path)
+        for suffix in ("", "-wal", "-shm"):
+            if os.path.exists(run_path + suffix):
+                os.remove(run_path + suffix)
+        if os.path.exists(os.path.splitext(run_path)[0] + ".covers"):
+            os.remove(os.path.splitext(run_path)[0] + ".covers")
+
+def git_commit():
+    try:
+        return subprocess.run(["git", "rev-parse", "HEAD"], capture_output=True, text=True, check=True,
+                              cwd=os.path.dirname(os.path.abspath(__file__))).stdout.strip()
+    except (OSError, subprocess.CalledProcessError):
+        return None
+
+# The number compared for a benchmark
+def headline(result):
+    for key in ("median", "seconds", "bytes"):
+        if key in result:
+            return result[key]
+    return None
+
+# Prints every benchmark that changed by more than COMPARE_THRESHOLD between two runs
+def compare(before, after):
+    for size, results in after["sizes"].items():
+        for name, result in results.items():
+            old = before["sizes"].get(size, {}).get(name)
+            if old is None:
+                continue
+            new_value = headline(result)
+            old_value = headline(old)
+            if not new_value or not old_value:
+                continue
+            higher_is_better = name.endswith("_per_second")
+            change = new_value / old_value - 1
+            if abs(change) >= COMPARE_THRESHOLD:
+                better = (change > 0) == higher_is_better
+                print(f"{size:>9} {name:<36} {old_value:>12.4g} -> {new_value:<12.4g} {change:+.0%} "
+                      f"{'better' if better else 'WORSE'}")
+
+def main():
+    parser = argparse.ArgumentParser(description="Benchmark Archive headlessly against synthetic collections.")
+    parser.add_argument("--sizes", type=int, nargs="+", default=BENCHMARK_SIZES, metavar="N",
+                        help="collection sizes to benchmark (default: %(default)s)")
+    parser.add_argument("--repeats", type=int, default=BENCHMARK_REPEATS, help="times each benchmark is run (default: %(default)s)")
+    parser.add_argument("--workdir", default=os.path.join(tempfile.gettempdir(), "archive-benchmark"),
+                        help="directory the synthetic databases are kept in (default: %(default)s)")
+    parser.add_argument("--output", default="benchmark.json", help="file the results are written to (default: %(default)s)")
+    parser.add_argument("--compare", metavar="FILE", help="results of an earlier run to compare against")
+    parser.add_argument("--run", type=int, help=argparse.SUPPRESS)
+    parser.add_argument("--result", help=argparse.SUPPRESS)
+    args = parser.parse_args()
+
+    if args.run is not None:
+        results = asyncio.run(run_benchmarks(args.run, args.repeats))
+        with open(args.result, "w") as result_file:
+            json.dump(results, result_file)
+        return
+
+    os.makedirs(args.workdir, exist_ok=True)
+    synthetic = SyntheticBooks()
+    report = {
+        "commit": git_commit(),
+        "python": platform.python_version(),
+        "platform": platform.platform(),
+        "repeats": args.repeats,
+        "sizes": {},
+    }
+    for size in args.sizes:
+        print(f"Benchmarking {size} books")
+        path, build_rate = build_database(args.workdir, size, synthetic)
+        results = run_size(path, size, args.repeats)
+        if build_rate is not None:
+            results["build_rows_per_second"] = {"median": build_rate, "samples": 1}
+        report["sizes"][str(size)] = results
+    with open(args.output, "w") as output_file:
+        json.dump(report, output_file, indent=2)
+    print(f"Results written to {args.output}")
+
+    if args.compare:
+        with open(args.compare) as compare_file:
+            compare(json.load(compare_file), report)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,180 @@
+import hashlib
+import mmap
+import os
+import threading
+from collections import OrderedDict
+from concurrent.futures import ThreadPoolExecutor
+from importlib.util import find_spec
+from io import BytesIO
+
+import requests
+from rich.color import Color
+from rich.segment import Segment
+from rich.style import Style
+from textual.strip import Strip
+
+from database import database
+from library import metadata_mirror, API_TIMEOUT
+
+# Pillow is only needed to decode the cover images. Without it covers are neither downloaded nor shown. It is
+# imported when the first cover is drawn, so it doesn't slow down start-up
+PILLOW_INSTALLED = find_spec("PIL") is not None
+
+
+# This script contains the cover cache, which downloads the cover thumbnails of books in the background, keeps them
+# in a pack file next to the database and draws them in the terminal
+
+# Size of a drawn cover in cells. Each cell is a half block showing two pixels, one above the other
+COVER_WIDTH = 16
+COVER_HEIGHT = 12
+
+# Number of covers downloaded at once, the largest image accepted, and how many drawn covers are kept in memory
+COVER_WORKERS = 4
+COVER_MAX_BYTES = 512 * 1024
+COVER_RENDER_CACHE = 128
+
+# Every downloaded image is appended to a single pack file, once per distinct image (images are named by the
+# SHA-256 of their bytes). The file is memory-mapped, so reading an image back is a slice of the map rather than a
+# read into a new buffer; the map is reopened whenever the file has grown past it
+class CoverPack:
+    def __init__(self, path=None):
+        self.path = path
+        self.lock = threading.Lock()
+        self.map = None
+
+    def pack_path(self):
+        if self.path is None:
+            database.connect_writer()
+            self.path = os.path.splitext(database.path)[0] + ".covers"
+        return self.path
+
+    # Appends an image and returns where it starts
+    def append(self, data):
+        with self.lock, open(self.pack_path(), "ab") as pack_file:
+            offset = pack_file.tell()
+            pack_file.write(data)
+        return offset
+
+    # Whether the pack holds an image at this place. It won't if the pack file has been deleted or cut short
+    def holds(self, offset, length):
+        try:
+            return os.path.getsize(self.pack_path()) >= offset + length
+        except OSError:
+            return False
+
+    # The bytes of an image, as a view of the memory map, or None if the pack doesn't hold it
+    def view(self, offset, length):
+        with self.lock:
+            if self.map is None or offset + length > len(self.map):
+                if not self.holds(offset, length):
+                    return None
+                with open(self.pack_path(), "rb") as pack_file:
+                    self.map = mmap.mmap(pack_file.fileno(), 0, access=mmap.ACCESS_READ)
+            return memoryview(self.map)[offset:offset + length]
+
+# Downloads, stores and draws book covers, looked up by ISBN-13. Covers are fetched by a small pool of worker
+# threads using the thumbnail addresses saved in the metadata mirror. The drawn covers most recently shown are
+# kept, so showing a cover again costs no network, no decoding and no new objects
+class CoverCache:
+    def __init__(self, db=database, pack=None, workers=COVER_WORKERS, render_cache=COVER_RENDER_CACHE):
+        self.db = db
+        self.pack = pack or CoverPack()
+        self.enabled = PILLOW_INSTALLED
+        self.executor = ThreadPoolExecutor(max_workers=workers, thread_name_prefix="cover")
+        self.session = requests.Session()
+        self.lock = threading.Lock()
+        self.render_cache = render_cache
+        self.rendered = OrderedDict()
+        # Callbacks waiting for each cover being fetched
+        self.waiting = {}
+
+    # Returns the drawn cover of a book if it has already been drawn. Otherwise it is loaded (or downloaded) in the
+    # background and on_ready(isbn13, strips) is called from the worker thread once it is ready
+    def get(self, isbn13, on_ready=None):
+        if not self.enabled or not isbn13:
+            return None
+        with self.lock:
+            strips = self.rendered.get(isbn13)
+            if strips is not None:
+                self.rendered.move_to_end(isbn13)
+                return strips
+            callbacks = self.waiting.get(isbn13)
+            if callbacks is None:
+                self.waiting[isbn13] = callbacks = []
+                self.executor.submit(self.load, isbn13)
+            if on_ready is not None:
+                callbacks.append(on_ready)
+        return None
+
+    # Starts fetching the covers of books that are likely to be shown soon
+    def prefetch(self, isbns):
+        for isbn13 in isbns:
+            self.get(isbn13)
+
+    # Runs in a worker: reads the cover from the pack, downloading it first if it isn't there, and draws it
+    def load(self, isbn13):
+        strips = None
+        try:
+            data = self.stored(isbn13)
+            if data is None:
+                data = self.download(isbn13)
+            if data is not None:
+                strips = draw_cover(data)
+        except (requests.RequestException, OSError, ValueError):
+            # Left to be tried again the next time the cover is shown
+            pass
+        finally:
+            with self.lock:
+                callbacks = self.waiting.pop(isbn13, [])
+                if strips is not None:
+                    self.rendered[isbn13] = strips
+                    if len(self.rendered) > self.render_cache:
+                        self.rendered.popitem(last=False)
+        if strips is not None:
+            for on_ready in callbacks:
+                on_ready(isbn13, strips)
+
+    def stored(self, isbn13):
+        with self.db.read() as conn:
+            row = conn.execute('''
+                SELECT cover_blob.offset, cover_blob.length
+                FROM cover JOIN cover_blob ON cover_blob.digest = cover.digest
+                WHERE cover.isbn13 = ?
+            ''', (isbn13,)).fetchone()
+        return self.pack.view(*row) if row else None
+
+    def download(self, isbn13):
+        url = metadata_mirror.thumbnail(isbn13)
+        if url is None:
+            return None
+        response = self.session.get(url, timeout=API_TIMEOUT)
+        response.raise_for_status()
+        data = response.content
+        if len(data) > COVER_MAX_BYTES:
+            return None
+        digest = hashlib.sha256(data).hexdigest()
+        with self.db.write() as conn:
+            row = conn.execute("SELECT offset, length FROM cover_blob WHERE digest = ?", (digest,)).fetchone()
+            if row is None or not self.pack.holds(*row):
+                conn.execute("INSERT OR REPLACE INTO cover_blob (digest, offset, length) VALUES (?, ?, ?)",
+                             (digest, self.pack.append(data), len(data)))
+            conn.execute("INSERT OR REPLACE INTO cover (isbn13, digest) VALUES (?, ?)", (isbn13, digest))
+        return data
+
+# Draws an image as COVER_HEIGHT lines of COVER_WIDTH half blocks, the top pixel of each cell in the foreground
+# colour and the bottom one in the background colour
+def draw_cover(data):
+    from PIL import Image
+
+    with Image.open(BytesIO(data)) as image:
+        pixels = image.convert("RGB").resize((COVER_WIDTH, COVER_HEIGHT * 2)).tobytes()
+    row_bytes = COVER_WIDTH * 3
+    strips = []
+    for line in range(COVER_HEIGHT):
+        top = pixels[line * 2 * row_bytes:(line * 2 + 1) * row_bytes]
+        bottom = pixels[(line * 2 + 1) * row_bytes:(line * 2 + 2) * row_bytes]
+        strips.append(Strip([Segment("▀", Style(color=Color.from_rgb(*top[x:x + 3]), bgcolor=Color.from_rgb(*bottom[x:x + 3])))
+                             for x in range(0, row_bytes, 3)], COVER_WIDTH))
+    return strips
+
+cover_cache = CoverCache()
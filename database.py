@@ -0,0 +1,450 @@
+import os
+import queue
+import sqlite3
+import threading
+from contextlib import contextmanager
+from urllib.parse import quote
+
+from platformdirs import user_data_dir
+
+from isbn import to_isbn13
+from stats import stats
+
+
+# This script contains the schema of the Archive database, the migrations that upgrade older databases in place and
+# the connections the rest of the app shares
+
+# Statements run by the triggers that keep the collection summary up to date as a book (row is new or old) is added
+# to or removed from book_list. A book counts towards the total, its author, its decade ('' if the year is unknown)
+# and the books without an ISBN. Books with the same title and author are counted in book_work, and every copy past
+# the first is a duplicate. Counts that fall to zero are removed, so summary rows only exist for values in use
+SUMMARY_DECADE = "CASE WHEN substr({row}.pub_year, 1, 4) GLOB '[0-9][0-9][0-9][0-9]' THEN substr({row}.pub_year, 1, 3) || '0s' ELSE '' END"
+SUMMARY_NO_ISBN = "(coalesce({row}.ISBN13, '') = '' AND coalesce({row}.ISBN10, '') = '')"
+SUMMARY_WORK = "title_key = lower({row}.title) AND author_key = lower({row}.author)"
+
+SUMMARY_ADD_BOOK = f'''
+        INSERT INTO collection_summary (kind, value, items)
+            VALUES ('total', '', 1), ('author', {{row}}.author, 1), ('decade', {SUMMARY_DECADE}, 1), ('no_isbn', '', {SUMMARY_NO_ISBN})
+            ON CONFLICT (kind, value) DO UPDATE SET items = items + excluded.items;
+        INSERT INTO book_work (title_key, author_key, copies) VALUES (lower({{row}}.title), lower({{row}}.author), 1)
+            ON CONFLICT (title_key, author_key) DO UPDATE SET copies = copies + 1;
+        INSERT INTO collection_summary (kind, value, items)
+            SELECT kind, '', 1 FROM book_work, (SELECT 'duplicates' AS kind UNION ALL SELECT 'duplicated_works')
+            WHERE {SUMMARY_WORK} AND (kind = 'duplicates' AND copies > 1 OR copies = 2)
+            ON CONFLICT (kind, value) DO UPDATE SET items = items + 1;'''
+
+SUMMARY_REMOVE_BOOK = f'''
+        UPDATE collection_summary SET items = items - 1
+            WHERE value = '' AND kind IN (SELECT 'duplicates' FROM book_work WHERE {SUMMARY_WORK} AND copies > 1
+                                          UNION ALL SELECT 'duplicated_works' FROM book_work WHERE {SUMMARY_WORK} AND copies = 2);
+        UPDATE book_work SET copies = copies - 1 WHERE {SUMMARY_WORK};
+        DELETE FROM book_work WHERE {SUMMARY_WORK} AND copies = 0;
+        UPDATE collection_summary SET items = items - CASE kind WHEN 'no_isbn' THEN {SUMMARY_NO_ISBN} ELSE 1 END
+            WHERE (kind, value) IN (VALUES ('total', ''), ('author', {{row}}.author), ('decade', {SUMMARY_DECADE}), ('no_isbn', ''));
+        DELETE FROM collection_summary WHERE (kind, value) IN (VALUES ('author', {{row}}.author), ('decade', {SUMMARY_DECADE})) AND items = 0;'''
+
+# Each migration upgrades the schema by one version, and the version a database is at is kept in its user_version.
+# New schema changes are added to the end of the list, never by editing a migration that has already shipped
+MIGRATIONS = [
+    # 1: the original book list table
+    '''
+    CREATE TABLE IF NOT EXISTS book_list (
+        id PRIMARY KEY,
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        pub_year TEXT,
+        ISBN13 TEXT,
+        ISBN10 TEXT
+    );
+    ''',
+
+    # 2: rebuild the book list with a real INTEGER PRIMARY KEY (an alias of the rowid) and add indexes. The ISBN
+    # columns are unique, so duplicates already in the table are dropped while copying. The title and author
+    # indexes cover every column shown in search results, so lookups never have to read the table itself
+    '''
+    CREATE TABLE book_list_new (
+        id INTEGER PRIMARY KEY,
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        pub_year TEXT,
+        ISBN13 TEXT,
+        ISBN10 TEXT
+    );
+    CREATE UNIQUE INDEX book_list_isbn13 ON book_list_new (ISBN13);
+    CREATE UNIQUE INDEX book_list_isbn10 ON book_list_new (ISBN10);
+    INSERT OR IGNORE INTO book_list_new (id, title, author, pub_year, ISBN13, ISBN10)
+        SELECT rowid, title, author, pub_year, NULLIF(ISBN13, ''), NULLIF(ISBN10, '') FROM book_list ORDER BY rowid;
+    DROP TABLE book_list;
+    ALTER TABLE book_list_new RENAME TO book_list;
+    CREATE INDEX book_list_title ON book_list (title COLLATE NOCASE, author, pub_year, ISBN13, ISBN10);
+    CREATE INDEX book_list_author ON book_list (author COLLATE NOCASE, title, pub_year, ISBN13, ISBN10);
+    ''',
+
+    # 3: full-text index of the book list for collection searches. It is an external content table, so it only
+    # stores the index and reads the text from book_list; the triggers keep the two in step. One, two and three
+    # character prefixes are indexed so the prefix queries used while typing stay fast from the very first letter
+    '''
+    CREATE VIRTUAL TABLE book_fts USING fts5(
+        title, author, ISBN13, ISBN10,
+        content = 'book_list', content_rowid = 'id', prefix = '1 2 3'
+    );
+    CREATE TRIGGER book_list_fts_insert AFTER INSERT ON book_list BEGIN
+        INSERT INTO book_fts (rowid, title, author, ISBN13, ISBN10)
+            VALUES (new.id, new.title, new.author, new.ISBN13, new.ISBN10);
+    END;
+    CREATE TRIGGER book_list_fts_delete AFTER DELETE ON book_list BEGIN
+        INSERT INTO book_fts (book_fts, rowid, title, author, ISBN13, ISBN10)
+            VALUES ('delete', old.id, old.title, old.author, old.ISBN13, old.ISBN10);
+    END;
+    CREATE TRIGGER book_list_fts_update AFTER UPDATE ON book_list BEGIN
+        INSERT INTO book_fts (book_fts, rowid, title, author, ISBN13, ISBN10)
+            VALUES ('delete', old.id, old.title, old.author, old.ISBN13, old.ISBN10);
+        INSERT INTO book_fts (rowid, title, author, ISBN13, ISBN10)
+            VALUES (new.id, new.title, new.author, new.ISBN13, new.ISBN10);
+    END;
+    INSERT INTO book_fts (book_fts) VALUES ('rebuild');
+    ''',
+
+    # 4: local copy of every volume fetched from the Books API, so book searches work without the network. Volumes
+    # are updated in place (never replaced), which keeps their rowid and lets the update trigger fix the index
+    '''
+    CREATE TABLE volume_mirror (
+        volume_id TEXT PRIMARY KEY,
+        title TEXT NOT NULL,
+        author TEXT NOT NULL,
+        publisher TEXT,
+        published TEXT,
+        ISBN13 TEXT,
+        ISBN10 TEXT,
+        fetched REAL NOT NULL
+    );
+    CREATE INDEX volume_mirror_isbn13 ON volume_mirror (ISBN13);
+    CREATE INDEX volume_mirror_isbn10 ON volume_mirror (ISBN10);
+    CREATE INDEX volume_mirror_fetched ON volume_mirror (fetched);
+    CREATE VIRTUAL TABLE volume_mirror_fts USING fts5(
+        title, author, ISBN13, ISBN10, publisher,
+        content = 'volume_mirror', prefix = '1 2 3'
+    );
+    CREATE TRIGGER volume_mirror_fts_insert AFTER INSERT ON volume_mirror BEGIN
+        INSERT INTO volume_mirror_fts (rowid, title, author, ISBN13, ISBN10, publisher)
+            VALUES (new.rowid, new.title, new.author, new.ISBN13, new.ISBN10, new.publisher);
+    END;
+    CREATE TRIGGER volume_mirror_fts_delete AFTER DELETE ON volume_mirror BEGIN
+        INSERT INTO volume_mirror_fts (volume_mirror_fts, rowid, title, author, ISBN13, ISBN10, publisher)
+            VALUES ('delete', old.rowid, old.title, old.author, old.ISBN13, old.ISBN10, old.publisher);
+    END;
+    CREATE TRIGGER volume_mirror_fts_update AFTER UPDATE ON volume_mirror BEGIN
+        INSERT INTO volume_mirror_fts (volume_mirror_fts, rowid, title, author, ISBN13, ISBN10, publisher)
+            VALUES ('delete', old.rowid, old.title, old.author, old.ISBN13, old.ISBN10, old.publisher);
+        INSERT INTO volume_mirror_fts (rowid, title, author, ISBN13, ISBN10, publisher)
+            VALUES (new.rowid, new.title, new.author, new.ISBN13, new.ISBN10, new.publisher);
+    END;
+    ''',
+
+    # 5: index every book by its ISBN-13 as a number, so an exact ISBN lookup is a single index probe. ISBN13 is
+    # first filled in (from ISBN10 where needed) in canonical form; a book whose canonical ISBN is already in the
+    # collection keeps its old value. isbn_key is computed from ISBN13 by SQLite itself, so every writer keeps it right
+    '''
+    UPDATE OR IGNORE book_list SET ISBN13 = coalesce(to_isbn13(ISBN13), to_isbn13(ISBN10), ISBN13);
+    ALTER TABLE book_list ADD COLUMN isbn_key INTEGER GENERATED ALWAYS AS (
+        CASE WHEN length(ISBN13) = 13 AND NOT ISBN13 GLOB '*[^0-9]*' THEN CAST(ISBN13 AS INTEGER) END
+    ) VIRTUAL;
+    CREATE UNIQUE INDEX book_list_isbn_key ON book_list (isbn_key);
+    ''',
+
+    # 6: number of Books API requests made each day, so the daily quota is tracked across runs of the app
+    '''
+    CREATE TABLE api_quota (
+        day TEXT PRIMARY KEY,
+        requests INTEGER NOT NULL
+    );
+    ''',
+
+    # 7: catalog of the other kinds of media in the collection (movies, games, ...). Each item has the columns all
+    # media share, with anything specific to its type kept as JSON in attributes. Books stay in book_list, which
+    # already holds and indexes them. The indexes lead with the title or creator, so they serve queries across
+    # every type at once as well as queries for a single one
+    '''
+    CREATE TABLE media_item (
+        id INTEGER PRIMARY KEY,
+        media_type TEXT NOT NULL,
+        title TEXT NOT NULL,
+        creator TEXT NOT NULL,
+        released TEXT,
+        identifier TEXT,
+        attributes TEXT NOT NULL DEFAULT '{}'
+    );
+    CREATE INDEX media_item_title ON media_item (title COLLATE NOCASE, media_type);
+    CREATE INDEX media_item_creator ON media_item (creator COLLATE NOCASE, media_type);
+    CREATE INDEX media_item_type ON media_item (media_type, title COLLATE NOCASE);
+    CREATE UNIQUE INDEX media_item_identifier ON media_item (media_type, identifier);
+    ''',
+
+    # 8: trigram index of book titles and authors for typo-tolerant searches. Every run of three characters is
+    # indexed, so a misspelt word still shares most of its trigrams with the right one. Like book_fts it only
+    # holds the index, kept in step with book_list by triggers. The vocab table gives the number of books each
+    # trigram appears in, so searches can start from the rarest ones
+    '''
+    CREATE VIRTUAL TABLE book_trigram USING fts5(
+        title, author,
+        content = 'book_list', content_rowid = 'id', tokenize = 'trigram', detail = 'column'
+    );
+    CREATE VIRTUAL TABLE book_trigram_vocab USING fts5vocab(book_trigram, 'row');
+    CREATE TRIGGER book_list_trigram_insert AFTER INSERT ON book_list BEGIN
+        INSERT INTO book_trigram (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END;
+    CREATE TRIGGER book_list_trigram_delete AFTER DELETE ON book_list BEGIN
+        INSERT INTO book_trigram (book_trigram, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+    END;
+    CREATE TRIGGER book_list_trigram_update AFTER UPDATE ON book_list BEGIN
+        INSERT INTO book_trigram (book_trigram, rowid, title, author) VALUES ('delete', old.id, old.title, old.author);
+        INSERT INTO book_trigram (rowid, title, author) VALUES (new.id, new.title, new.author);
+    END;
+    INSERT INTO book_trigram (book_trigram) VALUES ('rebuild');
+    ''',
+
+    # 9: the API response cache, which used to create its own table when it started. Databases that already
+    # have it keep their cached responses
+    '''
+    CREATE TABLE IF NOT EXISTS api_cache (
+        key TEXT PRIMARY KEY,
+        response TEXT NOT NULL,
+        created REAL NOT NULL,
+        last_used REAL NOT NULL
+    );
+    CREATE INDEX IF NOT EXISTS api_cache_last_used ON api_cache (last_used);
+    ''',
+
+    # 10: cover thumbnails. The thumbnail address of each volume is saved in the mirror. Downloaded images are kept
+    # in a separate pack file, once per distinct image: cover_blob says where each image (named by the SHA-256 of its
+    # bytes) is in the pack, and cover says which image is the cover of each ISBN
+    '''
+    ALTER TABLE volume_mirror ADD COLUMN thumbnail TEXT;
+    CREATE TABLE cover_blob (
+        digest TEXT PRIMARY KEY,
+        offset INTEGER NOT NULL,
+        length INTEGER NOT NULL
+    );
+    CREATE TABLE cover (
+        isbn13 TEXT PRIMARY KEY,
+        digest TEXT NOT NULL REFERENCES cover_blob (digest)
+    );
+    ''',
+
+    # 11: summary of the collection for the statistics view, kept up to date by triggers. collection_summary holds
+    # the number of items of each kind of count ('total', 'author', 'decade', 'media_type', 'no_isbn', 'duplicates'
+    # and 'duplicated_works') for each value. book_work counts the copies of every title and author, which is how
+    # duplicates are found. The existing collection is counted once here
+    '''
+    CREATE TABLE collection_summary (
+        kind TEXT NOT NULL,
+        value TEXT NOT NULL,
+        items INTEGER NOT NULL,
+        PRIMARY KEY (kind, value)
+    ) WITHOUT ROWID;
+    CREATE INDEX collection_summary_items ON collection_summary (kind, items DESC, value);
+    CREATE TABLE book_work (
+        title_key TEXT NOT NULL,
+        author_key TEXT NOT NULL,
+        copies INTEGER NOT NULL,
+        PRIMARY KEY (title_key, author_key)
+    ) WITHOUT ROWID;
+    CREATE TRIGGER book_list_summary_insert AFTER INSERT ON book_list BEGIN''' + SUMMARY_ADD_BOOK.format(row="new") + '''
+    END;
+    CREATE TRIGGER book_list_summary_delete AFTER DELETE ON book_list BEGIN''' + SUMMARY_REMOVE_BOOK.format(row="old") + '''
+    END;
+    CREATE TRIGGER book_list_summary_update AFTER UPDATE OF title, author, pub_year, ISBN13, ISBN10 ON book_list BEGIN'''
+        + SUMMARY_REMOVE_BOOK.format(row="old") + SUMMARY_ADD_BOOK.format(row="new") + '''
+    END;
+    CREATE TRIGGER media_item_summary_insert AFTER INSERT ON media_item BEGIN
+        INSERT INTO collection_summary (kind, value, items) VALUES ('media_type', new.media_type, 1)
+            ON CONFLICT (kind, value) DO UPDATE SET items = items + 1;
+    END;
+    CREATE TRIGGER media_item_summary_delete AFTER DELETE ON media_item BEGIN
+        UPDATE collection_summary SET items = items - 1 WHERE kind = 'media_type' AND value = old.media_type;
+        DELETE FROM collection_summary WHERE kind = 'media_type' AND value = old.media_type AND items = 0;
+    END;
+    CREATE TRIGGER media_item_summary_update AFTER UPDATE OF media_type ON media_item BEGIN
+        UPDATE collection_summary SET items = items - 1 WHERE kind = 'media_type' AND value = old.media_type;
+        DELETE FROM collection_summary WHERE kind = 'media_type' AND value = old.media_type AND items = 0;
+        INSERT INTO collection_summary (kind, value, items) VALUES ('media_type', new.media_type, 1)
+            ON CONFLICT (kind, value) DO UPDATE SET items = items + 1;
+    END;
+    INSERT INTO book_work (title_key, author_key, copies)
+        SELECT lower(title), lower(author), count(*) FROM book_list GROUP BY 1, 2;
+    INSERT INTO collection_summary (kind, value, items)
+        SELECT 'total', '', count(*) FROM book_list
+        UNION ALL SELECT 'no_isbn', '', count(*) FROM book_list WHERE ''' + SUMMARY_NO_ISBN.format(row="book_list") + '''
+        UNION ALL SELECT 'duplicates', '', coalesce(sum(copies - 1), 0) FROM book_work WHERE copies > 1
+        UNION ALL SELECT 'duplicated_works', '', count(*) FROM book_work WHERE copies > 1;
+    INSERT INTO collection_summary (kind, value, items)
+        SELECT 'author', author, count(*) FROM book_list GROUP BY author;
+    INSERT INTO collection_summary (kind, value, items)
+        SELECT 'decade', decade, count(*) FROM (SELECT ''' + SUMMARY_DECADE.format(row="book_list") + ''' AS decade FROM book_list)
+        GROUP BY decade;
+    INSERT INTO collection_summary (kind, value, items)
+        SELECT 'media_type', media_type, count(*) FROM media_item GROUP BY media_type;
+    ''',
+
+    # 12: books without an ISBN are told apart by their title and author instead, so adding or importing one that
+    # is already in the collection is skipped like any other duplicate. Empty ISBNs are stored as NULL first. Copies
+    # already in the collection are kept (they may well be real copies), so this is a trigger on new books rather
+    # than a unique index
+    '''
+    UPDATE book_list SET ISBN13 = NULL WHERE ISBN13 = '';
+    UPDATE book_list SET ISBN10 = NULL WHERE ISBN10 = '';
+    CREATE INDEX book_list_no_isbn ON book_list (lower(title), lower(author)) WHERE ISBN13 IS NULL AND ISBN10 IS NULL;
+    CREATE TRIGGER book_list_no_isbn_duplicate BEFORE INSERT ON book_list WHEN new.ISBN13 IS NULL AND new.ISBN10 IS NULL BEGIN
+        SELECT RAISE(IGNORE) WHERE EXISTS (
+            SELECT 1 FROM book_list INDEXED BY book_list_no_isbn
+            WHERE lower(title) = lower(new.title) AND lower(author) = lower(new.author) AND ISBN13 IS NULL AND ISBN10 IS NULL);
+    END;
+    ''',
+]
+
+# Brings a database up to the latest schema version. Each migration runs in its own transaction together with
+# the version bump, so an interrupted upgrade leaves the database at the last version that fully completed.
+# Migrations can use to_isbn13 to convert ISBNs
+def migrate(conn):
+    version = conn.execute("PRAGMA user_version").fetchone()[0]
+    if version < len(MIGRATIONS):
+        conn.create_function("to_isbn13", 1, to_isbn13, deterministic=True)
+    for number, migration in enumerate(MIGRATIONS[version:], start=version + 1):
+        try:
+            conn.executescript(f"BEGIN; {migration} PRAGMA user_version = {number}; COMMIT;")
+        except sqlite3.Error:
+            if conn.in_transaction:
+                conn.rollback()
+            raise
+    return len(MIGRATIONS)
+
+# The database lives in the user's data directory (the ARCHIVE_DB environment variable points it somewhere else).
+# Older versions kept it in the working directory, so an Archive.db found there is copied over the first time
+DATABASE_NAME = "Archive.db"
+DATABASE_ENV = "ARCHIVE_DB"
+
+def database_path():
+    path = os.environ.get(DATABASE_ENV)
+    if path:
+        return path
+    directory = user_data_dir("Archive", appauthor=False)
+    path = os.path.join(directory, DATABASE_NAME)
+    if not os.path.exists(path):
+        os.makedirs(directory, exist_ok=True)
+        if os.path.exists(DATABASE_NAME):
+            legacy = sqlite3.connect(DATABASE_NAME)
+            copy = sqlite3.connect(path)
+            try:
+                legacy.backup(copy)
+            finally:
+                copy.close()
+                legacy.close()
+    return path
+
+# Number of read-only connections kept for worker threads, and the memory map and page cache size of each
+# connection (a negative cache size is in KiB)
+READER_POOL_SIZE = 4
+MMAP_SIZE = 256 * 1024 * 1024
+CACHE_SIZE = -32 * 1024
+
+# Connection that times every statement it runs (until its first row is ready) for the Stats tab, by the statement's
+# first word. Only used when stats are turned on
+class TimedConnection(sqlite3.Connection):
+    def execute(self, sql, parameters=()):
+        with stats.timed("sql " + sql.split(None, 1)[0].lower()):
+            return super().execute(sql, parameters)
+
+    def executemany(self, sql, parameters):
+        with stats.timed("sql " + sql.split(None, 1)[0].lower()):
+            return super().executemany(sql, parameters)
+
+# The connections to the Archive database, shared by the whole app. There is a single writer connection, used by
+# one thread at a time, and a pool of read-only connections handed out to worker threads. With WAL journaling the
+# readers never wait for the writer, so searches keep running while books are being added. Connections are opened
+# on first use; the writer is opened first and brings the schema up to date
+class Database:
+    def __init__(self, path=None, readers=READER_POOL_SIZE):
+        self.path = path
+        self.readers = readers
+        self.lock = threading.RLock()
+        self.writer = None
+        self.pool_lock = threading.Lock()
+        self.pool = queue.LifoQueue()
+        self.opened = []
+        self.closed = False
+
+    def connection_class(self):
+        return TimedConnection if stats.enabled else sqlite3.Connection
+
+    def configure(self, conn):
+        conn.execute(f"PRAGMA mmap_size = {MMAP_SIZE}")
+        conn.execute(f"PRAGMA cache_size = {CACHE_SIZE}")
+        return conn
+
+    def connect_writer(self):
+        if self.writer is not None:
+            return self.writer
+        with self.lock:
+            if self.writer is None:
+                if self.path is None:
+                    self.path = database_path()
+                conn = sqlite3.connect(self.path, check_same_thread=False, cached_statements=256, factory=self.connection_class())
+                conn.execute("PRAGMA journal_mode = WAL")
+                conn.execute("PRAGMA synchronous = NORMAL")
+                migrate(conn)
+                self.writer = self.configure(conn)
+                self.closed = False
+            return self.writer
+
+    # Runs the block in a transaction on the writer connection, committed at the end (or rolled back if the
+    # block raises). Other threads wait for it to finish before they can write
+    @contextmanager
+    def write(self):
+        with self.lock:
+            conn = self.connect_writer()
+            with conn:
+                yield conn
+
+    # Lends a read-only connection for the block, opening a new one while there are fewer than the pool size and
+    # otherwise waiting for one to be returned. Readers never wait for the writer
+    @contextmanager
+    def read(self):
+        self.connect_writer()
+        try:
+            conn = self.pool.get_nowait()
+        except queue.Empty:
+            with self.pool_lock:
+                conn = None
+                if len(self.opened) < self.readers:
+                    conn = sqlite3.connect(f"file:{quote(os.path.abspath(self.path))}?mode=ro", uri=True,
+                                           check_same_thread=False, cached_statements=256, factory=self.connection_class())
+                    self.opened.append(self.configure(conn))
+            if conn is None:
+                conn = self.pool.get()
+        try:
+            yield conn
+        finally:
+            if self.closed:
+                conn.close()
+            else:
+                self.pool.put(conn)
+
+    # Closes every connection, letting SQLite update its query planner statistics first. Connections still lent
+    # out are closed as they are returned
+    def close(self):
+        with self.lock:
+            self.closed = True
+            with self.pool_lock:
+                while True:
+                    try:
+                        self.pool.get_nowait().close()
+                    except queue.Empty:
+                        break
+                self.opened.clear()
+            # Closed last, so it can checkpoint the WAL back into the database file
+            if self.writer is not None:
+                self.writer.execute("PRAGMA optimize")
+                self.writer.close()
+                self.writer = None
+
+database = Database()
@@ -0,0 +1,39 @@
+# This script contains the functions to check ISBN numbers and convert them to a single ISBN-13 form
+
+# Removes the hyphens and spaces ISBNs are often written with
+def clean_isbn(value):
+    return value.replace("-", "").replace(" ", "").upper()
+
+# ISBN-10: nine digits and a check digit (which can be X for 10), where the digits weighted 10 down to 1
+# add up to a multiple of 11
+def is_valid_isbn10(value):
+    value = clean_isbn(value)
+    if len(value) != 10 or not value[:9].isdigit() or not (value[9].isdigit() or value[9] == "X"):
+        return False
+    total = sum((10 - position) * int(digit) for position, digit in enumerate(value[:9]))
+    total += 10 if value[9] == "X" else int(value[9])
+    return total % 11 == 0
+
+# ISBN-13: thirteen digits, weighted alternately 1 and 3, that add up to a multiple of 10
+def isbn13_check_digit(first_twelve):
+    total = sum(int(digit) * (3 if position % 2 else 1) for position, digit in enumerate(first_twelve))
+    return str((10 - total % 10) % 10)
+
+def is_valid_isbn13(value):
+    value = clean_isbn(value)
+    return len(value) == 13 and value.isdigit() and isbn13_check_digit(value[:12]) == value[12]
+
+def is_valid_isbn(value):
+    return is_valid_isbn13(value) or is_valid_isbn10(value)
+
+# Converts a valid ISBN-10 or ISBN-13 to its ISBN-13, or returns None if it isn't a valid ISBN.
+# An ISBN-10 becomes an ISBN-13 by adding 978 to the front and working out a new check digit
+def to_isbn13(value):
+    if value is None:
+        return None
+    value = clean_isbn(value)
+    if is_valid_isbn13(value):
+        return value
+    if is_valid_isbn10(value):
+        return "978" + value[:9] + isbn13_check_digit("978" + value[:9])
+    return None
@@ -1,21 +1,552 @@
 import requests
-import sqlite3
+import re
+import threading
+import random
+import json
+import time
+from datetime import datetime, timezone
+from concurrent.futures import ThreadPoolExecutor, FIRST_COMPLETED, wait
+from contextlib import contextmanager, nullcontext
+from typing import NamedTuple, Optional
+from requests.adapters import HTTPAdapter
+from textual.fuzzy import Matcher
 
+from database import database
+from isbn import to_isbn13, is_valid_isbn
+from stats import stats
 
-# This script contains the functions to search for books through your collection or through Google Reads API
 
-conn = sqlite3.connect("Archive.db")
-cursor = conn.cursor()
+# This script contains the functions to search for books through your collection or through Google Reads API
 
 # Initial API URL set up
 APIurl = "https://www.googleapis.com/books/v1/volumes"
 
+# A book as it moves between the API, the database and the screen. It is a named tuple, so it has no per-instance
+# dictionary and can be passed as-is as the parameters of a book_list insert or as a DataTable row.
+# Two books are the same book when they share an ISBN (or, without one, a title and author)
+class Book(NamedTuple):
+    title: str = ""
+    author: str = ""
+    published: Optional[str] = None
+    isbn13: Optional[str] = None
+    isbn10: Optional[str] = None
+
+    @property
+    def key(self):
+        return self.isbn13 or self.isbn10 or (self.title.casefold(), self.author.casefold())
+
+    def __eq__(self, other):
+        if not isinstance(other, Book):
+            return NotImplemented
+        return self.key == other.key
+
+    def __ne__(self, other):
+        if not isinstance(other, Book):
+            return NotImplemented
+        return self.key != other.key
+
+    def __hash__(self):
+        return hash(self.key)
+
+    def __str__(self):
+        published = f" ({self.published})" if self.published else ""
+        return f"{self.title} by {self.author}{published}"
+
+# Connect and read timeouts (in seconds) for API calls, and the retry settings used when the API is busy
+# (429) or failing (5xx). Retries back off exponentially from API_BACKOFF up to API_BACKOFF_MAX seconds
+API_TIMEOUT = (3.05, 10)
+API_RETRIES = 4
+API_BACKOFF = 0.5
+API_BACKOFF_MAX = 8
+API_MAX_CONCURRENT = 4
+RETRY_STATUSES = {429, 500, 502, 503, 504}
+
+# Number of results requested per page from the API (the API allows at most 40)
+API_PAGE_SIZE = 20
+
+# Size (in bytes) of the pieces a streamed response body is read in
+STREAM_CHUNK_SIZE = 8192
+
+# Request rate allowed by the client (requests per second, with bursts of up to API_BURST), the number of requests
+# the API allows per day, and how many of those are kept back for interactive searches so bulk imports can't use
+# up the whole day's quota
+API_RATE = 2
+API_BURST = 5
+API_DAILY_QUOTA = 1000
+BULK_QUOTA_RESERVE = 100
+
+# Priorities of API requests: interactive searches go ahead of bulk work like imports and mirror refreshes
+INTERACTIVE = 0
+BULK = 1
+
+# Raised instead of sending a request once the day's quota has been used. It is a RequestException, so callers
+# fall back to the cache and the mirror just as they do when the API can't be reached
+class QuotaExceeded(requests.RequestException):
+    pass
+
+# Client-side limit on Books API requests: a token bucket for the per-second rate and a daily count for the quota,
+# saved in the database so it carries over between runs (days are counted in UTC). A waiting interactive request
+# is always let through before bulk requests, and bulk requests stop short of the quota by BULK_QUOTA_RESERVE
+class RateLimiter:
+    def __init__(self, db=database, rate=API_RATE, burst=API_BURST, daily_quota=API_DAILY_QUOTA,
+                 bulk_reserve=BULK_QUOTA_RESERVE):
+        self.db = db
+        self.rate = rate
+        self.burst = burst
+        self.daily_quota = daily_quota
+        self.bulk_reserve = bulk_reserve
+        self.tokens = burst
+        self.refilled = time.monotonic()
+        self.waiting_interactive = 0
+        self.condition = threading.Condition()
+        self.day = None
+        self.used = 0
+
+    # Requests used so far today, loading the saved count whenever the day changes
+    def used_today(self):
+        day = datetime.now(timezone.utc).date().isoformat()
+        if day != self.day:
+            with self.db.read() as conn:
+                row = conn.execute("SELECT requests FROM api_quota WHERE day = ?", (day,)).fetchone()
+            self.day = day
+            self.used = row[0] if row else 0
+        return self.used
+
+    def refill(self):
+        now = time.monotonic()
+        self.tokens = min(self.burst, self.tokens + (now - self.refilled) * self.rate)
+        self.refilled = now
+
+    # Waits until a request of the given priority may be sent and counts it against the quota. Raises
+    # QuotaExceeded straight away once the quota for that priority has been used
+    def acquire(self, priority=INTERACTIVE):
+        limit = self.daily_quota - (self.bulk_reserve if priority == BULK else 0)
+        with self.condition:
+            if priority == INTERACTIVE:
+                self.waiting_interactive += 1
+            try:
+                while True:
+                    if self.used_today() >= limit:
+                        raise QuotaExceeded(f"The daily limit of {limit} Books API requests has been reached")
+                    self.refill()
+                    if self.tokens >= 1 and (priority == INTERACTIVE or self.waiting_interactive == 0):
+                        self.tokens -= 1
+                        self.used += 1
+                        with self.db.write() as conn:
+                            conn.execute("INSERT INTO api_quota (day, requests) VALUES (?, 1) "
+                                         "ON CONFLICT (day) DO UPDATE SET requests = requests + 1", (self.day,))
+                        return
+                    self.condition.wait((1 - self.tokens) / self.rate if self.tokens < 1 else None)
+            finally:
+                if priority == INTERACTIVE:
+                    self.waiting_interactive -= 1
+                    self.condition.notify_all()
+
+    # Short quota summary for the status label
+    def stats(self):
+        with self.condition:
+            return f"quota: {self.used_today()}/{self.daily_quota} today"
+
+rate_limiter = RateLimiter()
+
+# Client for the Books API. It keeps one pooled keep-alive session, so repeated lookups reuse the same
+# connections instead of a new TCP/TLS handshake per request, and allows at most max_concurrent requests
+# at once. Every attempt is first cleared with the limiter, if there is one. The url can be pointed at a local
+# server for testing
+class BooksClient:
+    def __init__(self, url=APIurl, timeout=API_TIMEOUT, retries=API_RETRIES, backoff=API_BACKOFF,
+                 backoff_max=API_BACKOFF_MAX, max_concurrent=API_MAX_CONCURRENT, limiter=None):
+        self.url = url
+        self.limiter = limiter
+        self.timeout = timeout
+        self.retries = retries
+        self.backoff = backoff
+        self.backoff_max = backoff_max
+        self.slots = threading.BoundedSemaphore(max_concurrent)
+        self.session = requests.Session()
+        adapter = HTTPAdapter(pool_connections=1, pool_maxsize=max_concurrent)
+        self.session.mount("https://", adapter)
+        self.session.mount("http://", adapter)
+
+    # Sends a GET request with the given query and returns the response, retrying connection errors, timeouts and
+    # retryable statuses. Waiting between attempts happens outside the concurrency limit. With stream, the body
+    # is left to be read as it arrives. path is added to the end of the API url
+    def request(self, params, stream=False, path="", priority=INTERACTIVE):
+        for attempt in range(self.retries + 1):
+            response = None
+            if self.limiter:
+                self.limiter.acquire(priority)
+            with self.slots:
+                try:
+                    # A streamed body is only read as it is iterated, so stream() times those requests instead
+                    with nullcontext() if stream else stats.timed("api request"):
+                        response = self.session.get(self.url + path, params=params, timeout=self.timeout, stream=stream)
+                except (requests.ConnectionError, requests.Timeout):
+                    if attempt == self.retries:
+                        raise
+            if response is not None and (response.status_code not in RETRY_STATUSES or attempt == self.retries):
+                response.raise_for_status()
+                return response
+            if response is not None:
+                response.close()
+            time.sleep(self.backoff_delay(attempt, response))
+
+    # Returns the decoded JSON of a request
+    def get(self, params, priority=INTERACTIVE):
+        return self.request(params, priority=priority).json()
+
+    # Returns a single volume by its id
+    def get_volume(self, volume_id, priority=INTERACTIVE):
+        return self.request(None, path=f"/{volume_id}", priority=priority).json()
+
+    # Returns the body of a request as text chunks, read from the connection as they are iterated
+    def stream(self, params, priority=INTERACTIVE):
+        response = self.request(params, stream=True, priority=priority)
+        response.encoding = response.encoding or "utf-8"
+        # response.elapsed is how long the headers took to arrive, so this is when the request was sent
+        return self.read_body(response, time.perf_counter() - response.elapsed.total_seconds())
+
+    # Passes the chunks of a streamed body on, then records the request from when it was sent until the last chunk
+    # was read. The response is closed when the chunks are, so one that is given up on doesn't hold its connection
+    def read_body(self, response, sent):
+        try:
+            yield from response.iter_content(chunk_size=STREAM_CHUNK_SIZE, decode_unicode=True)
+            if stats.enabled:
+                stats.record("api request", time.perf_counter() - sent)
+        finally:
+            response.close()
+
+    # Delay before the next attempt: the server's Retry-After if it sent one, otherwise exponential backoff
+    # with jitter, capped at backoff_max either way
+    def backoff_delay(self, attempt, response=None):
+        retry_after = response.headers.get("Retry-After", "") if response is not None else ""
+        if retry_after.isdigit():
+            return min(float(retry_after), self.backoff_max)
+        return min(self.backoff * 2 ** attempt, self.backoff_max) * random.uniform(0.5, 1)
+
+    def close(self):
+        self.session.close()
+
+books_client = BooksClient(limiter=rate_limiter)
+
+# How long a cached API response stays valid (in seconds), and how many responses are kept before the
+# least recently used ones are removed
+CACHE_TTL = 7 * 24 * 60 * 60
+CACHE_MAX_ENTRIES = 1000
+
+# Persistent cache of API responses, stored in its own table of the Archive database so repeat searches
+# skip the network and still work offline. Entries are keyed on the normalized query, expire after ttl
+# seconds and are evicted least recently used first once there are more than max_entries. Expired entries are
+# only removed by that eviction, since they are still the fallback when the API can't be reached.
+# The cache is shared with search workers, so its hit counts and pending last-used times are guarded by a lock
+class ResponseCache:
+    UPDATE_LAST_USED = "UPDATE api_cache SET last_used = ? WHERE key = ?"
+
+    def __init__(self, db=database, ttl=CACHE_TTL, max_entries=CACHE_MAX_ENTRIES):
+        self.db = db
+        self.ttl = ttl
+        self.max_entries = max_entries
+        self.hits = 0
+        self.misses = 0
+        self.lock = threading.Lock()
+        # Last-used times from hits are kept here and written with the next insert (or on close), so a hit never
+        # waits on a commit
+        self.touched = {}
+
+    # Builds the cache key, ignoring case, surrounding whitespace and repeated spaces in the query values
+    @staticmethod
+    def key(params):
+        return json.dumps(sorted((name, " ".join(str(value).lower().split())) for name, value in params.items()))
+
+    # Returns the cached response body for a key, or None if it is missing or expired.
+    # With allow_stale, expired responses are still returned (used when the API can't be reached); these
+    # fallback lookups aren't counted, since the search was already counted as a miss
+    def get(self, key, allow_stale=False):
+        now = time.time()
+        with self.db.read() as conn:
+            row = conn.execute("SELECT response, created FROM api_cache WHERE key = ?", (key,)).fetchone()
+        with self.lock:
+            if row is None or (now - row[1] > self.ttl and not allow_stale):
+                if not allow_stale:
+                    self.misses += 1
+                return None
+            if not allow_stale:
+                self.hits += 1
+            self.touched[key] = now
+        return row[0]
+
+    # Takes the last-used times recorded since they were last written, as parameters of UPDATE_LAST_USED
+    def take_touched(self):
+        with self.lock:
+            touched = [(used, key) for key, used in self.touched.items()]
+            self.touched.clear()
+        return touched
+
+    # Stores a response body, then evicts the least recently used entries over the size cap
+    def put(self, key, response):
+        now = time.time()
+        touched = self.take_touched()
+        with self.db.write() as conn:
+            conn.executemany(self.UPDATE_LAST_USED, touched)
+            conn.execute("INSERT OR REPLACE INTO api_cache (key, response, created, last_used) VALUES (?, ?, ?, ?)",
+                         (key, response, now, now))
+            excess = conn.execute("SELECT COUNT(*) FROM api_cache").fetchone()[0] - self.max_entries
+            if excess > 0:
+                conn.execute("DELETE FROM api_cache WHERE key IN (SELECT key FROM api_cache ORDER BY last_used LIMIT ?)",
+                             (excess,))
+
+    def clear(self):
+        with self.lock, self.db.write() as conn:
+            conn.execute("DELETE FROM api_cache")
+            self.touched.clear()
+
+    # Writes the last-used times of hits since the last insert, so the eviction order survives a session of hits
+    def close(self):
+        touched = self.take_touched()
+        if touched:
+            with self.db.write() as conn:
+                conn.executemany(self.UPDATE_LAST_USED, touched)
+
+    # Short hit/miss summary for the status label
+    def stats(self):
+        return f"cache: {self.hits} hits, {self.misses} misses"
+
+response_cache = ResponseCache()
+
+# How long (in seconds) a volume in the local mirror is trusted before it is refreshed from the API, and how many
+# stale volumes are refreshed at a time
+MIRROR_MAX_AGE = 30 * 24 * 60 * 60
+MIRROR_REFRESH_BATCH = 20
+
+# Local copy of the metadata (authors, publisher, dates and identifiers) of every volume fetched from the API. Book
+# searches look here first, so they return at local speed and still work when the API can't be reached.
+# Volumes are refreshed from the API once they are older than max_age
+class MetadataMirror:
+    def __init__(self, db=database, max_age=MIRROR_MAX_AGE):
+        self.db = db
+        self.max_age = max_age
+
+    # Saves API volumes, updating any already in the mirror
+    def store(self, items):
+        now = time.time()
+        rows = [(item["id"], *normalize_volume(item), item.get("volumeInfo", {}).get("publisher"), volume_thumbnail(item), now)
+                for item in items if "id" in item]
+        with self.db.write() as conn:
+            conn.executemany('''
+                INSERT INTO volume_mirror (volume_id, title, author, published, ISBN13, ISBN10, publisher, thumbnail, fetched)
+                VALUES (?, ?, ?, ?, ?, ?, ?, ?, ?)
+                ON CONFLICT (volume_id) DO UPDATE SET
+                    title = excluded.title, author = excluded.author, published = excluded.published,
+                    ISBN13 = excluded.ISBN13, ISBN10 = excluded.ISBN10, publisher = excluded.publisher,
+                    thumbnail = excluded.thumbnail, fetched = excluded.fetched
+            ''', rows)
+
+    # Saves every volume in a complete API response body
+    def store_response(self, body):
+        self.store(json.loads(body).get("items", []))
+
+    # Searches the mirror the same way the collection is searched, best matches first
+    def search(self, title="", author="", isbn="", limit=API_PAGE_SIZE):
+        query = collection_match_query(title, author, to_isbn13(isbn) or isbn)
+        if not query:
+            return []
+        with self.db.read() as conn:
+            rows = conn.execute('''
+                SELECT volume_mirror.title, volume_mirror.author, volume_mirror.published, volume_mirror.ISBN13, volume_mirror.ISBN10
+                FROM volume_mirror_fts JOIN volume_mirror ON volume_mirror.rowid = volume_mirror_fts.rowid
+                WHERE volume_mirror_fts MATCH ?
+                ORDER BY rank
+                LIMIT ?
+            ''', (query, limit)).fetchall()
+        return [Book(*row) for row in rows]
+
+    # Address of the cover thumbnail of a book, if a volume with its ISBN has one
+    def thumbnail(self, isbn13):
+        with self.db.read() as conn:
+            row = conn.execute("SELECT thumbnail FROM volume_mirror WHERE ISBN13 = ? AND thumbnail IS NOT NULL LIMIT 1",
+                               (isbn13,)).fetchone()
+        return row[0] if row else None
+
+    # Ids of the volumes that are due for a refresh, oldest first
+    def stale(self, limit=MIRROR_REFRESH_BATCH):
+        with self.db.read() as conn:
+            rows = conn.execute("SELECT volume_id FROM volume_mirror WHERE fetched < ? ORDER BY fetched LIMIT ?",
+                                (time.time() - self.max_age, limit)).fetchall()
+        return [volume_id for volume_id, in rows]
+
+    # Marks volumes as just fetched without changing them, so a volume that can't be refreshed waits its turn again
+    # instead of staying first in line
+    def touch(self, volume_ids):
+        with self.db.write() as conn:
+            conn.executemany("UPDATE volume_mirror SET fetched = ? WHERE volume_id = ?",
+                             [(time.time(), volume_id) for volume_id in volume_ids])
+
+    def remove(self, volume_ids):
+        with self.db.write() as conn:
+            conn.executemany("DELETE FROM volume_mirror WHERE volume_id = ?", [(volume_id,) for volume_id in volume_ids])
+
+metadata_mirror = MetadataMirror()
+
+# Re-fetches the oldest volumes in the mirror that are due for a refresh, returning how many were refreshed. Each
+# volume is fetched on its own: volumes the API no longer has are removed, and ones that fail in any other way are
+# put back at the end of the line. The batch stops early when the API can't be reached or the quota is used up,
+# keeping the volumes refreshed so far
+def refresh_stale_volumes(limit=MIRROR_REFRESH_BATCH):
+    volumes = []
+    missing = []
+    failed = []
+    try:
+        for volume_id in metadata_mirror.stale(limit):
+            try:
+                volumes.append(books_client.get_volume(volume_id, priority=BULK))
+            except requests.HTTPError as e:
+                (missing if e.response is not None and e.response.status_code == 404 else failed).append(volume_id)
+            except ValueError:
+                failed.append(volume_id)
+    finally:
+        metadata_mirror.store(volumes)
+        metadata_mirror.remove(missing)
+        metadata_mirror.touch(failed)
+    return len(volumes)
+
+# One response shared by every caller that made the same request while it was in flight. The chunks of the body
+# are kept as they are read, and whichever caller is furthest ahead reads the next one from the connection, so each
+# caller sees the whole body no matter how far the others have got (or whether they stopped reading).
+# Once the body is complete it is passed to on_complete; an error is raised to every caller. If every caller stops
+# reading before the body is complete, the response is closed and fails, so no later request can join it
+class SharedResponse:
+    def __init__(self, on_complete=None, on_finish=None):
+        self.on_complete = on_complete
+        self.on_finish = on_finish
+        self.source = None
+        self.chunks = []
+        self.done = False
+        self.error = None
+        self.ready = threading.Event()
+        self.lock = threading.Lock()
+        self.readers = 0
+        self.readers_lock = threading.Lock()
+
+    # Called by the caller that made the request, with the response chunks or the error it failed with
+    def start(self, source):
+        self.source = iter(source)
+        self.ready.set()
+
+    def fail(self, error):
+        self.error = error
+        self.ready.set()
+        if self.on_finish:
+            self.on_finish()
+
+    # Counts a caller that will read the response, unless it has already failed or been given up on
+    def join(self):
+        with self.readers_lock:
+            if self.error is not None:
+                return False
+            self.readers += 1
+            return True
+
+    # Called when a caller stops reading, whether or not it got to the end
+    def leave(self):
+        with self.readers_lock:
+            self.readers -= 1
+            abandoned = self.readers == 0 and not self.done and self.error is None and self.source is not None
+            if abandoned:
+                self.error = requests.ConnectionError("Every reader stopped before the response was complete")
+        if abandoned:
+            with self.lock:
+                if hasattr(self.source, "close"):
+                    self.source.close()
+            self.fail(self.error)
+
+    # Waits for the request to be made, raising its error if it failed
+    def wait(self):
+        self.ready.wait()
+        if self.error is not None and self.source is None:
+            raise self.error
+        return self
+
+    # Each caller that joined reads the response through this exactly once, and leaves when it is done with it
+    def __iter__(self):
+        position = 0
+        try:
+            while True:
+                if position < len(self.chunks):
+                    yield self.chunks[position]
+                    position += 1
+                    continue
+                with self.lock:
+                    if position < len(self.chunks):
+                        continue
+                    if self.error is not None:
+                        raise self.error
+                    if self.done:
+                        return
+                    try:
+                        chunk = next(self.source, None)
+                    except Exception as e:
+                        self.fail(e)
+                        raise
+                    if chunk is not None:
+                        self.chunks.append(chunk)
+                        continue
+                    self.done = True
+                    if self.on_finish:
+                        self.on_finish()
+                    if self.on_complete:
+                        self.on_complete("".join(self.chunks))
+                return
+        finally:
+            self.leave()
+
+# Single-flight layer for API requests. While a request for a key is in flight, further requests for the same key
+# wait for it and share its response instead of sending their own. coalesced counts the requests saved this way
+class RequestCoalescer:
+    def __init__(self):
+        self.lock = threading.Lock()
+        self.inflight = {}
+        self.coalesced = 0
+
+    # Returns the response chunks for a key, calling start() to make the request only if no identical request is
+    # already in flight
+    def fetch(self, key, start, on_complete=None):
+        with self.lock:
+            shared = self.inflight.get(key)
+            leader = shared is None or not shared.join()
+            if leader:
+                shared = SharedResponse(on_complete, on_finish=lambda: self.forget(key, shared))
+                shared.join()
+                self.inflight[key] = shared
+            else:
+                self.coalesced += 1
+        if not leader:
+            return shared.wait()
+        try:
+            shared.start(start())
+        except Exception as e:
+            shared.fail(e)
+            raise
+        return shared
+
+    def forget(self, key, shared):
+        with self.lock:
+            if self.inflight.get(key) is shared:
+                del self.inflight[key]
+
+request_coalescer = RequestCoalescer()
+
 # Search online for books using the API based on inputed query data
 # Defaults to empty strings
-# First takes inputs and preps them for api search
-def book_search_api(title = "", author = "", isbn = ""):
+# First takes inputs and preps them for api search. Results are paged, starting from start_index.
+# An ISBN is checked before anything is sent, and always searched for as its ISBN-13. priority is passed on to the
+# rate limiter (BULK for imports and other background work)
+def book_search_api(title = "", author = "", isbn = "", start_index = 0, max_results = API_PAGE_SIZE, priority = INTERACTIVE):
     params = {}
     new_params = "q="
+    if len(isbn) != 0:
+        isbn = to_isbn13(isbn)
+        if isbn is None:
+            raise ValueError("Please enter a valid ISBN-10 or ISBN-13")
 
     # Create API URL based on inputs
     if len(title) != 0:
@@ -26,44 +557,546 @@ def book_search_api(title = "", author = "", isbn = ""):
         params["isbn:"] = isbn
     
     new_params += "+".join("{}{}".format(key,value) for key,value in params.items())
+    new_params += "&startIndex={}&maxResults={}".format(start_index, max_results)
+    params["startIndex"] = start_index
+    params["maxResults"] = max_results
 
-    r = requests.get(APIurl, params=new_params)
-    return r.json()
+    # Repeat searches are answered from the cache; if the API can't be reached an expired entry is better than nothing.
+    # A response from the API is streamed, shared with any identical search made while it is in flight, and cached
+    # and added to the mirror once it has been read to the end
+    cache_key = response_cache.key(params)
+    cached = response_cache.get(cache_key)
+    if cached is not None:
+        return VolumeStream([cached])
+
+    def save_response(body):
+        response_cache.put(cache_key, body)
+        metadata_mirror.store_response(body)
 
-# Searches the API based on inputs once they are verified, checking for errors
-def book_api_search_results(search_json):
-    search_title = []
-    search_author = []
-    search_pub = []
-    search_isbn10 = []
-    search_isbn13 = []
     try:
-        if search_json and "items" in search_json:
-            for item in search_json["items"]:
-                volume_info = item.get("volumeInfo")
-                book_title = volume_info.get("title")
-                book_authors = ", ".join(volume_info.get("authors"))
-                book_published = volume_info.get("publishedDate")
-                identifiers = volume_info.get("industryIdentifiers", [])
-                for identifier in identifiers:
-                    if identifier.get("type") == "ISBN_13":
-                        search_isbn13.append(identifier.get("identifier"))
-                    elif identifier.get("type") == "ISBN_10":
-                        search_isbn10.append(identifier.get("identifier"))
-                search_title.append(book_title)
-                search_author.append(book_authors)
-                search_pub.append(book_published)
-        return list(zip(search_title, search_author, search_pub, search_isbn13, search_isbn10))
-    except Exception as e:
-        return e
-
-# Add selected search result to collection
+        chunks = request_coalescer.fetch(cache_key, lambda: books_client.stream(new_params, priority), on_complete=save_response)
+    except requests.RequestException:
+        cached = response_cache.get(cache_key, allow_stale=True)
+        if cached is None:
+            raise
+        return VolumeStream([cached])
+    return VolumeStream(chunks)
+
+# A Books API response that is parsed as it is read. Iterating it yields the volumes of its "items" list one at a
+# time, each as soon as its part of the body has arrived, so the whole response never has to be decoded at once.
+# total_items is filled in from the body as it is read, and count is the number of volumes yielded so far. The
+# rest of the body is still read after the last volume, so a shared response is completed when it is read to the end
+class VolumeStream:
+    def __init__(self, chunks):
+        self.chunks = iter(chunks)
+        self.total_items = 0
+        self.count = 0
+        self.buffer = ""
+        self.position = 0
+        self.decoder = json.JSONDecoder()
+
+    # Reads the next chunk into the buffer, dropping the part that has already been parsed
+    def read(self):
+        chunk = next(self.chunks, None)
+        if chunk is None:
+            return False
+        self.buffer = self.buffer[self.position:] + chunk
+        self.position = 0
+        return True
+
+    # Returns the next character that isn't whitespace, without consuming it ("" at the end of the body)
+    def peek(self):
+        while True:
+            while self.position < len(self.buffer) and self.buffer[self.position].isspace():
+                self.position += 1
+            if self.position < len(self.buffer) or not self.read():
+                return self.buffer[self.position:self.position + 1]
+
+    def expect(self, expected):
+        char = self.peek()
+        if char not in expected:
+            raise ValueError(f"Unexpected {char!r} in API response, expected one of {expected!r}")
+        self.position += 1
+        return char
+
+    def items(self):
+        self.expect("[")
+        end = self.peek() == "]"
+        if end:
+            self.position += 1
+        while not end:
+            self.count += 1
+            yield self.value()
+            end = self.expect(",]") == "]"
+
+    # Decodes the next JSON value, reading more of the body until it is complete. A value that runs to the very end
+    # of the buffer could be a number that continues in the next chunk, so it is only accepted once more has
+    # arrived or the body has ended
+    def value(self):
+        self.peek()
+        while True:
+            try:
+                decoded, end = self.decoder.raw_decode(self.buffer, self.position)
+                if end < len(self.buffer):
+                    self.position = end
+                    return decoded
+            except json.JSONDecodeError:
+                pass
+            if not self.read():
+                decoded, self.position = self.decoder.raw_decode(self.buffer, self.position)
+                return decoded
+
+    def __iter__(self):
+        self.expect("{")
+        end = self.peek() == "}"
+        if end:
+            self.position += 1
+        while not end:
+            key = self.value()
+            self.expect(":")
+            if key == "items":
+                yield from self.items()
+            elif key == "totalItems":
+                self.total_items = self.value()
+            else:
+                self.value()
+            end = self.expect(",}") == "}"
+        while self.read():
+            pass
+
+    # Stops reading the response part way through. A shared response is closed once no other caller is reading it
+    def close(self):
+        if hasattr(self.chunks, "close"):
+            self.chunks.close()
+
+# Turns one volume from the API into a Book. A missing title or author is left empty and a missing identifier
+# is None, so every field stays in its own column whatever the volume is missing. The ISBN13 is always given in
+# canonical form, worked out from the ISBN10 if the volume only has that
+def normalize_volume(item):
+    volume_info = item.get("volumeInfo", {})
+    isbn13 = None
+    isbn10 = None
+    for identifier in volume_info.get("industryIdentifiers", []):
+        if identifier.get("type") == "ISBN_13":
+            isbn13 = identifier.get("identifier")
+        elif identifier.get("type") == "ISBN_10":
+            isbn10 = identifier.get("identifier")
+    return Book(volume_info.get("title", ""), ", ".join(volume_info.get("authors", [])), volume_info.get("publishedDate"),
+                to_isbn13(isbn13) or to_isbn13(isbn10) or isbn13, isbn10)
+
+# Address of the cover thumbnail of an API volume
+def volume_thumbnail(item):
+    image_links = item.get("volumeInfo", {}).get("imageLinks", {})
+    return image_links.get("thumbnail") or image_links.get("smallThumbnail")
+
+# Searches the API based on inputs once they are verified, yielding one record per volume as the results are read.
+# Takes either a streamed response or an already decoded one
+def book_api_search_results(search):
+    items = search.get("items", []) if isinstance(search, dict) else search
+    for item in items:
+        yield normalize_volume(item)
+
+# Number of books buffered by a CollectionRepository before they are written in one transaction
+COLLECTION_BATCH_SIZE = 500
+
+# Write path for the book collection. Added books are buffered and written with a single executemany per
+# transaction on the shared writer connection, so large batches cost one commit instead of one per row. The insert
+# statement is always the same string, so sqlite3 keeps it prepared in its statement cache. Books already in the
+# collection are skipped: by the unique indexes on the ISBNs, or by a trigger on the title and author for books
+# without an ISBN
+class CollectionRepository:
+    INSERT_BOOK = "INSERT OR IGNORE INTO book_list (title, author, pub_year, ISBN13, ISBN10) VALUES (?, ?, ?, ?, ?)"
+
+    def __init__(self, db=database, batch_size=COLLECTION_BATCH_SIZE):
+        self.db = db
+        self.batch_size = batch_size
+        self.pending = []
+        # Number of books written so far that were new to the collection
+        self.added = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc_info):
+        self.close()
+
+    # Queues a Book, writing the queue once it reaches batch_size. The ISBN13 is stored in canonical form (which
+    # is what the isbn_key index is built from), and empty ISBNs are stored as NULL so they don't collide in the
+    # unique indexes
+    def add(self, book):
+        isbn13 = to_isbn13(book.isbn13) or to_isbn13(book.isbn10) or book.isbn13 or None
+        if isbn13 != book.isbn13 or not book.isbn10:
+            book = book._replace(isbn13=isbn13, isbn10=book.isbn10 or None)
+        self.pending.append(book)
+        if len(self.pending) >= self.batch_size:
+            self.flush()
+
+    def add_many(self, books):
+        for book in books:
+            self.add(book)
+
+    # Writes all queued books in a single transaction and returns how many were new to the collection
+    def flush(self):
+        if not self.pending:
+            return 0
+        # rowcount only counts the books inserted, not the rows the full-text index triggers write
+        with self.db.write() as conn:
+            added = conn.executemany(self.INSERT_BOOK, self.pending).rowcount
+        self.pending.clear()
+        self.added += added
+        return added
+
+    # All ISBN13 and ISBN10 values already in the collection
+    def isbns(self):
+        existing = set()
+        with self.db.read() as conn:
+            for isbn13, isbn10 in conn.execute("SELECT ISBN13, ISBN10 FROM book_list"):
+                existing.update(isbn for isbn in (isbn13, isbn10) if isbn)
+        return existing
+
+    # Writes anything still queued. The connection is shared, so it stays open
+    def close(self):
+        self.flush()
+
+collection = CollectionRepository()
+
+# Add selected search result to collection, returning False if it was already there
 def add_to_collection(result):
-    title = result[0]
-    author = result[1]
-    pub = result[2]
-    isbn13 = result[3]
-    isbn10 = result[4]
-
-    cursor.execute("INSERT INTO book_list (title, author, pub, isbn13, isbn10) VALUES (?, ?)",
-                    (title, author, pub, isbn13, isbn10))
\ No newline at end of file
+    collection.add(result)
+    return collection.flush() > 0
+
+# Markers put around matched words in collection search results, and the number of results returned per page
+HIGHLIGHT_START = "\x02"
+HIGHLIGHT_END = "\x03"
+COLLECTION_PAGE_SIZE = 50
+RANK_LIMIT = 2000
+
+# Lends a read-only connection for collection searches run from worker threads. A search that has been replaced
+# by a newer one can be stopped mid-query with interrupt_collection_search
+searching = set()
+
+@contextmanager
+def collection_reader(db=database):
+    with db.read() as conn:
+        searching.add(conn)
+        try:
+            yield conn
+        finally:
+            searching.discard(conn)
+
+def interrupt_collection_search():
+    for conn in list(searching):
+        conn.interrupt()
+
+# Builds a full-text query where every word typed into a field has to match a word in that column. The last word
+# may still be being typed, so it only has to match the start of a word (unless it is followed by a space)
+def collection_match_query(title="", author="", isbn=""):
+    query = []
+    for columns, value in (("title", title), ("author", author), ("{ISBN13 ISBN10}", isbn)):
+        words = [f'"{word}"' for word in re.findall(r"\w+", value)]
+        if words:
+            if not value[-1].isspace():
+                words[-1] += "*"
+            query.append(f"{columns} : (" + " AND ".join(words) + ")")
+    return " AND ".join(query)
+
+# Searches the collection through the full-text index, best matches first. Titles come back as a short
+# snippet and authors in full, both with the matched words wrapped in the highlight markers.
+# Ranking has to score every match, so a search matching more than RANK_LIMIT books (like the first letter or
+# two of a title, which can match most of the collection) comes back in collection order instead, where the
+# limit ends the scan early
+def search_collection(conn, title="", author="", isbn="", limit=COLLECTION_PAGE_SIZE, offset=0):
+    # A complete ISBN identifies a single book, found with one probe of the isbn_key index
+    isbn13 = to_isbn13(isbn)
+    if isbn13:
+        return conn.execute("SELECT id, title, author, pub_year, ISBN13, ISBN10 FROM book_list WHERE isbn_key = ? LIMIT ? OFFSET ?",
+                            (int(isbn13), limit, offset)).fetchall()
+    query = collection_match_query(title, author, isbn)
+    if not query:
+        return []
+    matches = conn.execute("SELECT count(*) FROM (SELECT 1 FROM book_fts WHERE book_fts MATCH ? LIMIT ?)",
+                           (query, RANK_LIMIT + 1)).fetchone()[0]
+    order = "bm25(book_fts, 10.0, 5.0, 1.0, 1.0)" if matches <= RANK_LIMIT else "book_fts.rowid"
+    return conn.execute(f'''
+        SELECT book_fts.rowid,
+               snippet(book_fts, 0, :start, :end, '...', 12),
+               highlight(book_fts, 1, :start, :end),
+               book_list.pub_year, book_list.ISBN13, book_list.ISBN10
+        FROM book_fts JOIN book_list ON book_list.id = book_fts.rowid
+        WHERE book_fts MATCH :query
+        ORDER BY {order}
+        LIMIT :limit OFFSET :offset
+    ''', {"query": query, "start": HIGHLIGHT_START, "end": HIGHLIGHT_END, "limit": limit, "offset": offset}).fetchall()
+
+# Typo-tolerant collection searches look for books sharing the FUZZY_TRIGRAMS rarest trigrams of what was typed,
+# rank at most FUZZY_RANK_LIMIT of them, rerank the best FUZZY_CANDIDATES by how closely they match, and keep those
+# scoring at least FUZZY_MIN_SCORE
+FUZZY_TRIGRAMS = 12
+FUZZY_RANK_LIMIT = 10000
+FUZZY_CANDIDATES = 200
+FUZZY_MIN_SCORE = 0.4
+
+# Shortest word that is matched on its own. Shorter words (like "a" or "of") are found inside almost any word, so
+# they would make every book a close match
+FUZZY_MIN_WORD = 3
+
+# Every run of three characters in a value, lowercased the same way as the trigram index
+def trigrams(value):
+    value = value.lower()
+    return {value[position:position + 3] for position in range(len(value) - 2)}
+
+# The trigrams that appear in the fewest books, which narrow the search down the most. Trigrams that appear in no
+# book can't help find one, so they are left out
+def rarest_trigrams(conn, grams, count=FUZZY_TRIGRAMS):
+    grams = list(grams)
+    books = dict(conn.execute(f"SELECT term, doc FROM book_trigram_vocab WHERE term IN ({', '.join('?' * len(grams))})", grams))
+    return sorted(books, key=books.get)[:count]
+
+# Wraps the characters at the given positions in the highlight markers
+def mark_positions(value, positions):
+    marked = []
+    for position, character in enumerate(value):
+        if position in positions and position - 1 not in positions:
+            marked.append(HIGHLIGHT_START)
+        marked.append(character)
+        if position in positions and position + 1 not in positions:
+            marked.append(HIGHLIGHT_END)
+    return "".join(marked)
+
+# Scores how closely a field of a book matches what was typed into it, from 0 to 1, and returns the field with the
+# matched letters marked. Half the score is the share of typed trigrams the field contains. The other half comes
+# from matching each typed word against the closest word in the field, scored by textual's fuzzy Matcher relative
+# to a perfect match. A word whose letters aren't all there in order (like "Tolkein" for "Tolkien") is scored by
+# the trigrams the two words share instead
+def fuzzy_field_score(value, matchers, field):
+    typed = trigrams(value)
+    score = len(typed & trigrams(field)) / len(typed)
+    words = [(match.start(), match.group()) for match in re.finditer(r"\w+", field)]
+    positions = set()
+    word_scores = []
+    for matcher, perfect in matchers:
+        best, best_positions = 0.0, ()
+        for start, word in words:
+            word_score, offsets = matcher.fuzzy_search.match(matcher.query, word)
+            word_score /= perfect
+            if not word_score:
+                query_grams = trigrams(matcher.query)
+                shared = query_grams & trigrams(word)
+                word_score = len(shared) / len(query_grams) if query_grams else 0.0
+                offsets = {offset + letter for offset in range(len(word) - 2) if word[offset:offset + 3].lower() in shared
+                           for letter in range(3)}
+            if word_score > best:
+                best, best_positions = word_score, [start + offset for offset in offsets]
+        word_scores.append(best)
+        positions.update(best_positions)
+    if word_scores:
+        score = (score + sum(word_scores) / len(word_scores)) / 2
+    return score, mark_positions(field, positions)
+
+# Searches the collection for books whose title and author are close to what was typed, even when misspelt, best
+# matches first. Returns rows like search_collection, with the matched letters marked. A field is only searched
+# when it has a word of at least FUZZY_MIN_WORD characters
+def fuzzy_search_collection(conn, title="", author="", limit=COLLECTION_PAGE_SIZE):
+    fields = [(column, value.strip()) for column, value in ((1, title), (2, author))
+              if any(len(word) >= FUZZY_MIN_WORD for word in re.findall(r"\w+", value))]
+    if not fields:
+        return []
+    grams = {}
+    for column, value in fields:
+        grams[column] = rarest_trigrams(conn, trigrams(value))
+        if not grams[column]:
+            return []
+    # Ranking scores every book found, so while the trigrams match more than FUZZY_RANK_LIMIT books only the
+    # rarer half of them are kept. Only when a single trigram per field still matches too many books are the
+    # candidates taken in collection order instead
+    while True:
+        query = " AND ".join(("title" if column == 1 else "author") + " : (" +
+                             " OR ".join('"' + gram.replace('"', '""') + '"' for gram in grams[column]) + ")"
+                             for column, _ in fields)
+        matches = conn.execute("SELECT count(*) FROM (SELECT 1 FROM book_trigram WHERE book_trigram MATCH ? LIMIT ?)",
+                               (query, FUZZY_RANK_LIMIT + 1)).fetchone()[0]
+        if matches <= FUZZY_RANK_LIMIT or all(len(column_grams) == 1 for column_grams in grams.values()):
+            break
+        grams = {column: column_grams[:max(1, len(column_grams) // 2)] for column, column_grams in grams.items()}
+    order = "bm25(book_trigram)" if matches <= FUZZY_RANK_LIMIT else "book_trigram.rowid"
+    candidates = conn.execute(f'''
+        SELECT book_list.id, book_list.title, book_list.author, book_list.pub_year, book_list.ISBN13, book_list.ISBN10
+        FROM book_trigram JOIN book_list ON book_list.id = book_trigram.rowid
+        WHERE book_trigram MATCH ?
+        ORDER BY {order}
+        LIMIT ?
+    ''', (query, FUZZY_CANDIDATES)).fetchall()
+
+    matchers = {}
+    for column, value in fields:
+        matchers[column] = [(matcher, matcher.match(word)) for word in re.findall(r"\w+", value)
+                            if len(word) >= FUZZY_MIN_WORD for matcher in (Matcher(word),)]
+    ranked = []
+    for row in candidates:
+        row = list(row)
+        total = 0.0
+        for column, value in fields:
+            score, row[column] = fuzzy_field_score(value, matchers[column], row[column])
+            total += score
+        if total / len(fields) >= FUZZY_MIN_SCORE:
+            ranked.append((total / len(fields), tuple(row)))
+    ranked.sort(key=lambda match: match[0], reverse=True)
+    return [row for _, row in ranked[:limit]]
+
+# Number of books in the collection, read from the summary the triggers keep rather than counted
+def collection_count(conn):
+    row = conn.execute("SELECT items FROM collection_summary WHERE kind = 'total' AND value = ''").fetchone()
+    return row[0] if row else 0
+
+# Number of authors shown in the collection summary
+SUMMARY_TOP_AUTHORS = 10
+
+# Counts shown in the collection summary. authors, decades and media_types are lists of (value, count) pairs;
+# duplicates is the number of books with the same title and author as another, and duplicated_works the number
+# of titles that have more than one copy
+class CollectionSummary(NamedTuple):
+    books: int
+    no_isbn: int
+    duplicates: int
+    duplicated_works: int
+    authors: list
+    decades: list
+    media_types: list
+
+# Reads the collection summary kept up to date by the triggers, so it costs the same however large the collection
+# is: each part is a single range of the summary's index rather than a GROUP BY over every book
+def collection_summary(conn, top_authors=SUMMARY_TOP_AUTHORS):
+    totals = dict(conn.execute("SELECT kind, items FROM collection_summary WHERE value = '' "
+                               "AND kind IN ('total', 'no_isbn', 'duplicates', 'duplicated_works')"))
+    by_count = "SELECT value, items FROM collection_summary WHERE kind = ? ORDER BY items DESC, value LIMIT ?"
+    # Books are counted by the total, the media catalog's other types by media_type
+    media_types = conn.execute(by_count, ("media_type", -1)).fetchall()
+    if totals.get("total"):
+        media_types = sorted(media_types + [("book", totals["total"])], key=lambda media: (-media[1], media[0]))
+    return CollectionSummary(
+        books=totals.get("total", 0),
+        no_isbn=totals.get("no_isbn", 0),
+        duplicates=totals.get("duplicates", 0),
+        duplicated_works=totals.get("duplicated_works", 0),
+        authors=conn.execute(by_count, ("author", top_authors)).fetchall(),
+        decades=conn.execute("SELECT value, items FROM collection_summary WHERE kind = 'decade' ORDER BY value = '', value").fetchall(),
+        media_types=media_types,
+    )
+
+# One page of the collection in id order, starting after the given id. Paging by id (keyset pagination) reads
+# only the rows returned, so a page deep into a large collection costs the same as the first one
+def collection_page(conn, after_id=0, limit=COLLECTION_PAGE_SIZE):
+    return conn.execute("SELECT id, title, author, pub_year, ISBN13, ISBN10 FROM book_list WHERE id > ? ORDER BY id LIMIT ?",
+                        (after_id, limit)).fetchall()
+
+# Id of the book just before a position in the collection, used to jump straight to a far away page. id is the
+# rowid, so OFFSET steps through the table row by row and costs more the further it goes (about 6ms over 300k
+# books). The walk starts from the nearest place whose id is known: after_id, the id of the book just before
+# after_position, or the end of the collection when its total is given
+def collection_id_before(conn, position, after_id=0, after_position=0, total=None):
+    if position <= 0:
+        return 0
+    if total is not None and 0 <= total - position < position - after_position:
+        row = conn.execute("SELECT id FROM book_list ORDER BY id DESC LIMIT 1 OFFSET ?", (total - position,)).fetchone()
+    else:
+        row = conn.execute("SELECT id FROM book_list WHERE id > ? ORDER BY id LIMIT 1 OFFSET ?",
+                           (after_id, position - after_position - 1)).fetchone()
+    return row[0] if row else None
+
+# Number of ISBNs resolved through the API at once during a bulk import, and how many new books are
+# written per transaction
+IMPORT_WORKERS = API_MAX_CONCURRENT
+IMPORT_BATCH_SIZE = 100
+
+# Reads ISBNs from a barcode scanner dump or similar file. ISBNs can be separated by new lines, spaces or
+# commas, and hyphens are ignored. Valid ISBNs are returned as ISBN-13s, so an ISBN-10 and the ISBN-13 of the
+# same book are only returned once; anything that isn't a valid ISBN is returned unchanged
+def read_isbn_file(path):
+    isbns = []
+    seen = set()
+    with open(path, encoding="utf-8") as isbn_file:
+        for line in isbn_file:
+            for value in line.replace(",", " ").split():
+                isbn = to_isbn13(value) or value
+                if isbn not in seen:
+                    seen.add(isbn)
+                    isbns.append(isbn)
+    return isbns
+
+# Looks up a single ISBN through the API, returning the first matching book or None. The whole response is
+# read, so it is cached
+def resolve_isbn(isbn):
+    scanned = to_isbn13(isbn)
+    search_results = list(book_api_search_results(book_search_api(isbn=isbn, priority=BULK)))
+    # The API can return other volumes than the one asked for, so the volume with the scanned ISBN is used. A
+    # volume without any ISBN is given the scanned one, so it is recognised the next time it is imported
+    for book in search_results:
+        if scanned in (to_isbn13(book.isbn13), to_isbn13(book.isbn10)):
+            return book
+    for book in search_results:
+        if not book.isbn13 and not book.isbn10:
+            return book._replace(isbn13=scanned)
+    return None
+
+# Resolves a list of ISBNs through the API with a bounded pool of workers and adds the books that aren't
+# already in the collection, committing them in batches. progress(done, total) is called as each ISBN is
+# finished, and the import stops early once cancelled() returns True. Writes through its own
+# CollectionRepository so it can be called from a worker thread. Returns counts of what happened to each ISBN
+def import_isbns(isbns, db=database, progress=None, cancelled=None, workers=IMPORT_WORKERS,
+                 batch_size=IMPORT_BATCH_SIZE):
+    counts = {"added": 0, "duplicate": 0, "not_found": 0, "invalid": 0, "failed": 0}
+    repository = CollectionRepository(db, batch_size=batch_size)
+    existing = repository.isbns()
+
+    # Invalid ISBNs and ones already in the collection are skipped without calling the API
+    pending = []
+    for isbn in isbns:
+        if not is_valid_isbn(isbn):
+            counts["invalid"] += 1
+        elif isbn in existing:
+            counts["duplicate"] += 1
+        else:
+            pending.append(isbn)
+    total = len(isbns)
+    done = counts["duplicate"] + counts["invalid"]
+    if progress:
+        progress(done, total)
+
+    # Only a few lookups are queued ahead of the workers, so a cancelled import stops quickly
+    remaining = iter(pending)
+    running = set()
+    queued = 0
+    try:
+        with ThreadPoolExecutor(max_workers=workers) as executor:
+            while True:
+                while len(running) < workers * 2 and not (cancelled and cancelled()):
+                    isbn = next(remaining, None)
+                    if isbn is None:
+                        break
+                    running.add(executor.submit(resolve_isbn, isbn))
+                if not running:
+                    break
+                finished, running = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    try:
+                        book = future.result()
+                    except Exception:
+                        counts["failed"] += 1
+                    else:
+                        if book is None:
+                            counts["not_found"] += 1
+                        elif book.isbn13 in existing or book.isbn10 in existing:
+                            counts["duplicate"] += 1
+                        else:
+                            existing.update(isbn for isbn in (book.isbn13, book.isbn10) if isbn)
+                            repository.add(book)
+                            queued += 1
+                    done += 1
+                    if progress:
+                        progress(done, total)
+    finally:
+        repository.close()
+    # Books that were queued but skipped when written were already in the collection
+    counts["added"] = repository.added
+    counts["duplicate"] += queued - repository.added
+    return counts
@@ -0,0 +1,99 @@
+import json
+import threading
+import time
+from bisect import bisect_left
+from contextlib import contextmanager
+
+
+# This script contains the optional instrumentation of Archive. When it is turned on (with --stats), API requests, SQL
+# statements, table updates and screen refreshes are timed, and their latencies are counted in histograms which are
+# shown on the Stats tab and can be saved to a file. When it is off, timing something costs a single check
+
+# Upper bounds (in seconds) of the histogram buckets: four per doubling from 10 microseconds to about 3 minutes, so
+# every percentile is within 19% of the real value. Slower samples go in one last bucket
+HISTOGRAM_MIN = 0.00001
+HISTOGRAM_STEPS_PER_DOUBLING = 4
+HISTOGRAM_BOUNDS = tuple(HISTOGRAM_MIN * 2 ** (step / HISTOGRAM_STEPS_PER_DOUBLING) for step in range(97))
+
+STATS_PERCENTILES = (50, 95, 99)
+STATS_FILE = "archive-stats.json"
+
+# Latencies of one kind of operation. The histogram is a fixed list of bucket counts, so it uses the same memory
+# however many samples it has seen; percentiles are read from the buckets
+class Histogram:
+    def __init__(self, bounds=HISTOGRAM_BOUNDS):
+        self.bounds = bounds
+        self.counts = [0] * (len(bounds) + 1)
+        self.count = 0
+        self.total = 0.0
+        self.max = 0.0
+
+    def record(self, seconds):
+        self.counts[bisect_left(self.bounds, seconds)] += 1
+        self.count += 1
+        self.total += seconds
+        if seconds > self.max:
+            self.max = seconds
+
+    # The upper bound of the bucket the percentile falls in, but never more than the slowest sample
+    def percentile(self, percent):
+        if not self.count:
+            return 0.0
+        rank = percent / 100 * self.count
+        seen = 0
+        for bucket, count in enumerate(self.counts):
+            seen += count
+            if seen >= rank and count:
+                return min(self.bounds[bucket], self.max) if bucket < len(self.bounds) else self.max
+        return self.max
+
+    def summary(self):
+        summary = {"count": self.count, "mean": self.total / self.count if self.count else 0.0}
+        summary.update((f"p{percent}", self.percentile(percent)) for percent in STATS_PERCENTILES)
+        summary["max"] = self.max
+        return summary
+
+# Histograms by name, recorded from any thread
+class Stats:
+    def __init__(self):
+        self.enabled = False
+        self.started = time.time()
+        self.lock = threading.Lock()
+        self.histograms = {}
+
+    def record(self, name, seconds):
+        with self.lock:
+            histogram = self.histograms.get(name)
+            if histogram is None:
+                self.histograms[name] = histogram = Histogram()
+            histogram.record(seconds)
+
+    # Times the block and records it under name, if stats are turned on
+    @contextmanager
+    def timed(self, name):
+        if not self.enabled:
+            yield
+            return
+        start = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.record(name, time.perf_counter() - start)
+
+    # Summaries of every histogram, sorted by name
+    def snapshot(self):
+        with self.lock:
+            return {name: self.histograms[name].summary() for name in sorted(self.histograms)}
+
+    def clear(self):
+        with self.lock:
+            self.histograms.clear()
+        self.started = time.time()
+
+    # Saves the summaries (in seconds) to a JSON file
+    def dump(self, path=STATS_FILE):
+        with open(path, "w") as stats_file:
+            json.dump({"started": self.started, "saved": time.time(), "latencies": self.snapshot()}, stats_file, indent=2)
+        return path
+
+stats = Stats()
@@ -0,0 +1,149 @@
+import csv
+import json
+import struct
+import zlib
+
+from database import database
+from library import Book, CollectionRepository
+
+
+# This script contains the functions to export the collection to a file and import it again, as CSV, JSON lines
+# or a compact columnar format. Books are moved a chunk at a time in both directions, so the memory used stays
+# the same however large the collection is
+
+EXPORT_COLUMNS = ("title", "author", "pub_year", "ISBN13", "ISBN10")
+CHUNK_SIZE = 10000
+
+# The columnar format starts with COLUMNAR_MAGIC and the column names, followed by chunks of rows. Each chunk is its
+# row count, then each column as a zlib-compressed JSON list of its values (so similar values compress together),
+# each preceded by its length. A row count of 0 ends the file
+COLUMNAR_MAGIC = b"ARCHCOL1"
+
+# Reads the collection in chunks of rows, paging by id so every chunk costs the same
+def collection_chunks(conn, chunk_size=CHUNK_SIZE):
+    last_id = 0
+    while True:
+        rows = conn.execute("SELECT id, title, author, pub_year, ISBN13, ISBN10 FROM book_list WHERE id > ? ORDER BY id LIMIT ?",
+                            (last_id, chunk_size)).fetchall()
+        if not rows:
+            return
+        last_id = rows[-1][0]
+        yield [row[1:] for row in rows]
+
+def export_csv(chunks, path):
+    with open(path, "w", newline="", encoding="utf-8") as export_file:
+        writer = csv.writer(export_file)
+        writer.writerow(EXPORT_COLUMNS)
+        for chunk in chunks:
+            writer.writerows(chunk)
+
+def read_csv(path, chunk_size=CHUNK_SIZE):
+    with open(path, newline="", encoding="utf-8") as import_file:
+        reader = csv.reader(import_file)
+        next(reader, None)
+        chunk = []
+        for row in reader:
+            # CSV has no NULL, so empty year and ISBN fields are read back as missing values. Titles and authors
+            # can't be missing, and an empty one (such as a volume without authors) stays empty
+            chunk.append(Book(*row[:2], *(value or None for value in row[2:len(EXPORT_COLUMNS)])))
+            if len(chunk) == chunk_size:
+                yield chunk
+                chunk = []
+        if chunk:
+            yield chunk
+
+def export_jsonl(chunks, path):
+    with open(path, "w", encoding="utf-8") as export_file:
+        for chunk in chunks:
+            export_file.writelines(json.dumps(dict(zip(EXPORT_COLUMNS, row)), ensure_ascii=False) + "\n" for row in chunk)
+
+def read_jsonl(path, chunk_size=CHUNK_SIZE):
+    with open(path, encoding="utf-8") as import_file:
+        chunk = []
+        for line in import_file:
+            if line.strip():
+                record = json.loads(line)
+                chunk.append(Book(*(record.get(column) for column in EXPORT_COLUMNS)))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+def export_columnar(chunks, path):
+    with open(path, "wb") as export_file:
+        names = json.dumps(EXPORT_COLUMNS).encode()
+        export_file.write(COLUMNAR_MAGIC + struct.pack("<I", len(names)) + names)
+        for chunk in chunks:
+            export_file.write(struct.pack("<I", len(chunk)))
+            for column in zip(*chunk):
+                data = zlib.compress(json.dumps(column, ensure_ascii=False).encode())
+                export_file.write(struct.pack("<I", len(data)) + data)
+        export_file.write(struct.pack("<I", 0))
+
+def read_columnar(path, chunk_size=CHUNK_SIZE):
+    with open(path, "rb") as import_file:
+        if import_file.read(len(COLUMNAR_MAGIC)) != COLUMNAR_MAGIC:
+            raise ValueError(f"{path} is not a columnar Archive export")
+
+        def read_block():
+            length, = struct.unpack("<I", import_file.read(4))
+            return import_file.read(length)
+
+        # The file's chunks were written with the exporter's chunk size, so rows are regrouped into chunk_size
+        columns = json.loads(read_block())
+        chunk = []
+        while True:
+            row_count, = struct.unpack("<I", import_file.read(4))
+            if row_count == 0:
+                break
+            values = {name: json.loads(zlib.decompress(read_block())) for name in columns}
+            for row in zip(*(values.get(column, [None] * row_count) for column in EXPORT_COLUMNS)):
+                chunk.append(Book(*row))
+                if len(chunk) == chunk_size:
+                    yield chunk
+                    chunk = []
+        if chunk:
+            yield chunk
+
+# Export and import functions by format, picked from the file extension when no format is given
+FORMATS = {
+    "csv": (export_csv, read_csv),
+    "jsonl": (export_jsonl, read_jsonl),
+    "arc": (export_columnar, read_columnar),
+}
+
+def file_format(path, format=None):
+    format = format or path.rsplit(".", 1)[-1].lower()
+    if format not in FORMATS:
+        raise ValueError(f"Unknown format {format!r}, expected one of {', '.join(FORMATS)}")
+    return format
+
+# Writes the whole collection to a file, returning the number of books exported
+def export_collection(path, format=None, db=database, chunk_size=CHUNK_SIZE):
+    export, _ = FORMATS[file_format(path, format)]
+    exported = 0
+
+    def counted(chunks):
+        nonlocal exported
+        for chunk in chunks:
+            exported += len(chunk)
+            yield chunk
+
+    with db.read() as conn:
+        export(counted(collection_chunks(conn, chunk_size)), path)
+    return exported
+
+# Adds the books in an exported file to the collection, one transaction per chunk. Books already in the collection
+# (by ISBN, or by title and author for books without one) are skipped. Returns the number of books read and the
+# number added
+def import_collection(path, format=None, db=database, chunk_size=CHUNK_SIZE):
+    _, read = FORMATS[file_format(path, format)]
+    read_count = 0
+    added = 0
+    with CollectionRepository(db, batch_size=chunk_size + 1) as repository:
+        for chunk in read(path, chunk_size):
+            repository.add_many(chunk)
+            added += repository.flush()
+            read_count += len(chunk)
+    return read_count, added